@@ -1,4 +1,7 @@
-from .palm_code import PalmSetup
+from .bsread_reader import BsreadReader
+from .cache import ResultCache
+from .executor import Executor
+from .palm_code import PalmSetup, load_palm_results, save_palm_results
 from .spatial_encoder import SpatialEncoder
 from .spectral_encoder import SpectralEncoder
 from .file_adapter import FileAdapter
@@ -20,6 +20,7 @@ from bokeh.models import (
     Panel,
     PanTool,
     Plot,
+    RadioButtonGroup,
     ResetTool,
     Slider,
     Spacer,
@@ -30,9 +31,14 @@ from bokeh.models import (
     WheelZoomTool,
 )
 
+from photodiag.palm_code import save_palm_results
+
 PLOT_CANVAS_WIDTH = 620
 PLOT_CANVAS_HEIGHT = 380
 
+# results of all runs are appended to this file in the save folder when saving in HDF5 format
+RESULTS_FILENAME = "palm_results.h5"
+
 
 def create(palm):
     energy_min = palm.energy_range.min()
@@ -223,7 +229,10 @@ def create(palm):
             nonlocal h5_update_fun, current_results
             saved_runs_dropdown.label = new_value
             filepath = os.path.join(path_textinput.value, new_value)
-            tags, delays, lengths, debug_data = palm.process_hdf5_file(filepath, debug=True)
+            # forking a process pool in the bokeh server is problematic, so threads are used
+            tags, delays, lengths, debug_data = palm.process_hdf5_file(
+                filepath, debug=True, nproc=nproc_spinner.value, backend="thread"
+            )
             current_results = (new_value, tags, delays, lengths)
 
             if autosave_checkbox.active:
@@ -306,11 +315,17 @@ def create(palm):
     energy_npoints_spinner = Spinner(title="Number of interpolation points:", value=energy_npoints)
     energy_npoints_spinner.on_change("value", energy_npoints_spinner_callback)
 
+    # Number of worker threads spinner
+    nproc_spinner = Spinner(title="Number of threads:", value=1, low=1, high=os.cpu_count())
+
     # Save location
     save_textinput = TextInput(
         title="Save Folder Path:", value=os.path.join(os.path.expanduser("~"))
     )
 
+    # Save format radiobutton
+    save_format_radiobutton = RadioButtonGroup(labels=["CSV", "HDF5"], active=0, width=250)
+
     # Autosave checkbox
     autosave_checkbox = CheckboxButtonGroup(labels=["Auto Save"], active=[], width=250)
 
@@ -318,9 +333,16 @@ def create(palm):
     def save_button_callback():
         if current_results[0]:
             filename, tags, delays, lengths = current_results
-            save_filename = os.path.splitext(filename)[0] + ".csv"
-            df = pd.DataFrame({"pulse_id": tags, "pulse_delay": delays, "pulse_length": lengths})
-            df.to_csv(os.path.join(save_textinput.value, save_filename), index=False)
+            run = os.path.splitext(filename)[0]
+            if save_format_radiobutton.active == 0:
+                save_filename = run + ".csv"
+                df = pd.DataFrame(
+                    {"pulse_id": tags, "pulse_delay": delays, "pulse_length": lengths}
+                )
+                df.to_csv(os.path.join(save_textinput.value, save_filename), index=False)
+            else:
+                save_filepath = os.path.join(save_textinput.value, RESULTS_FILENAME)
+                save_palm_results(save_filepath, run, tags, delays, lengths)
 
     save_button = Button(label="Save Results", button_type="default", width=250)
     save_button.on_click(save_button_callback)
@@ -338,8 +360,10 @@ def create(palm):
                 energy_min_spinner,
                 energy_max_spinner,
                 energy_npoints_spinner,
+                nproc_spinner,
                 Spacer(height=30),
                 save_textinput,
+                save_format_radiobutton,
                 autosave_checkbox,
                 save_button,
             ),
@@ -0,0 +1,605 @@
+import logging
+import warnings
+
+import h5py
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# read_rows: limit on the size of a single block read from datasets
+MAX_BLOCK_NBYTES = 2 ** 26
+# read_rows: minimal fraction of selected rows for a block to be read as a whole
+MIN_BLOCK_DENSITY = 0.1
+# read_rows: largest number of runs of consecutive rows relative to the number of selected rows,
+# for which a block of a contiguous dataset is read per runs directly into the output array
+MAX_RUNS_FRACTION = 0.1
+# default size of the hdf5 raw data chunk cache per dataset
+RDCC_NBYTES = 2 ** 26
+# align_pulse_ids: largest span of common pulse ids relative to the number of pulses in a channel,
+# for which common pulse ids are merged via a lookup table
+MAX_SPAN_FACTOR = 16
+
+
+class BsreadReader:
+    """Reader of bsread hdf5 files.
+
+    A file is opened once and its layout is detected once, so that all channels (signal,
+    background, events, I0, etc.) are served from the same file handle.
+
+    With `memmap` enabled, data of contiguous uncompressed datasets is memory-mapped directly from
+    the file instead of being read via h5py. Consecutive rows are then served as views into the
+    file without copying them into RAM, and the OS page cache is shared between all processes
+    reading the same file. Chunked or compressed datasets are still read via h5py.
+
+    Data datasets are kept open together with their hdf5 chunk caches, so that chunks shared by
+    subsequent reads are decompressed only once, as long as they fit into the cache.
+    """
+
+    def __init__(self, filepath, memmap=False, rdcc_nbytes=RDCC_NBYTES, rdcc_nslots=None):
+        """Initialize BsreadReader object and open a file.
+
+        Args:
+            filepath: path to a bsread hdf5 file to read data from
+            memmap: memory-map data of contiguous uncompressed datasets
+            rdcc_nbytes: size of the hdf5 raw data chunk cache per dataset in bytes (None for the
+                h5py default of 1 MiB)
+            rdcc_nslots: number of chunk slots in the chunk cache (None for the h5py default)
+        """
+        self.filepath = filepath
+        self.memmap = memmap
+        self._h5f = h5py.File(filepath, "r", rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots)
+
+        if "/data" in self._h5f:
+            # sf_databuffer_writer format
+            self._path_prefix = "/data/{}"
+        else:
+            # bsread format
+            self._path_prefix = "/{}"
+
+        self._pulse_ids = {}
+        self._datasets = {}
+        self._memmaps = {}
+        # alignment statistics of the last aligned channels
+        self.alignment_stats = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the file.
+        """
+        self._memmaps.clear()
+        self._datasets.clear()
+        self._h5f.close()
+
+    def __getitem__(self, channel):
+        """Return hdf5 group of a channel.
+        """
+        return self._h5f[self._path_prefix.format(channel)]
+
+    def pulse_id(self, channel):
+        """Return pulse ids of a channel (they are read from the file only once).
+        """
+        if channel not in self._pulse_ids:
+            self._pulse_ids[channel] = self[channel]["pulse_id"][:]
+
+        return self._pulse_ids[channel]
+
+    def dataset(self, channel):
+        """Return data dataset of a channel (it is opened only once).
+        """
+        if channel not in self._datasets:
+            self._datasets[channel] = self[channel]["data"]
+
+        return self._datasets[channel]
+
+    def select_pulses(
+        self, signal_channel, events_channel=None, dark_shot_event=21, dark_shot_filter=None
+    ):
+        """Select valid pulses of a signal channel and identify dark shots among them.
+
+        Args:
+            signal_channel: data channel of encoder
+            events_channel: data channel of events
+            dark_shot_event: event number for dark shots if events_channel is present
+            dark_shot_filter: a function to return True for dark shots based on pulse_id argument
+        Returns:
+            pulse_id, sorted index of valid pulses in the signal channel, is_dark
+        """
+        if events_channel:
+            pulse_id, (index, event_index), stats = self.align((signal_channel, events_channel))
+
+            # if both groups have 0 in their pulse_id
+            if stats[0]["zeroed"] and stats[1]["zeroed"]:
+                warnings.warn(
+                    f"\n \
+                File: {self.filepath}\n \
+                Both '{signal_channel}' and '{events_channel}' have zeroed pulse_id(s).\n"
+                )
+
+        else:
+            pulse_id, (index,), _ = self.align((signal_channel,))
+
+        if np.any(index[1:] < index[:-1]):
+            # pulse ids are not monotonic, but rows are read in the file order
+            order = np.argsort(index)
+            pulse_id = pulse_id[order]
+            index = index[order]
+            if events_channel:
+                event_index = event_index[order]
+
+        if events_channel:
+            is_dark = np.empty(index.size, dtype=bool)
+            event_order = np.argsort(event_index)
+            is_dark[event_order] = self.read_rows(
+                events_channel, event_index[event_order], (dark_shot_event,)
+            )
+
+        elif dark_shot_filter:
+            is_dark = np.asarray(dark_shot_filter(pulse_id), dtype=bool)
+
+        else:
+            is_dark = None
+
+        return pulse_id, index, is_dark
+
+    def align(self, channels):
+        """Align pulses of several channels.
+
+        Args:
+            channels: data channels to be aligned, e.g. signal, background, events, I0, etc.
+        Returns:
+            common pulse ids, list of indices of common pulses per channel, alignment statistics
+            per channel (see `align_pulse_ids`)
+        """
+        pulse_id, indices, stats = align_pulse_ids([self.pulse_id(ch) for ch in channels])
+        self.alignment_stats = dict(zip(channels, stats))
+        report_alignment(self.filepath, self.alignment_stats)
+
+        return pulse_id, indices, stats
+
+    def read_rows(self, channel, index, selection=()):
+        """Read selected rows of channel data.
+
+        Args:
+            channel: data channel
+            index: boolean mask or sorted integer indices of rows to be read
+            selection: (optional) tuple of selections along the other axes of data
+        Returns:
+            array with selected rows (a read-only view into the file for a single run of rows of
+            a memory-mapped dataset)
+        """
+        if self.memmap:
+            if channel not in self._memmaps:
+                self._memmaps[channel] = memmap_dataset(self.dataset(channel))
+
+            array = self._memmaps[channel]
+            if array is not None:
+                return read_memmap_rows(array, index, selection)
+
+        return read_rows(self.dataset(channel), index, selection)
+
+    def read_images(self, channel, index, roi=(None, None), roi_x=(None, None)):
+        """Read camera images in their original data type.
+
+        Args:
+            channel: data channel of a camera
+            index: boolean mask or sorted integer indices of images to be read
+            roi: region of interest along y-axis
+            roi_x: region of interest along x-axis
+        Returns:
+            camera images
+        """
+        return self.read_rows(channel, index, (slice(*roi), slice(*roi_x)))
+
+    def read(
+        self,
+        signal_channel,
+        events_channel=None,
+        dark_shot_event=21,
+        dark_shot_filter=None,
+        roi=(None, None),
+        roi_x=(None, None),
+        dtype=float,
+    ):
+        """Read encoder data.
+
+        Args:
+            signal_channel: data channel of encoder
+            events_channel: data channel of events
+            dark_shot_event: event number for dark shots if events_channel is present
+            dark_shot_filter: a function to return True for dark shots based on pulse_id argument
+            roi: region of interest for image projection along y-axis
+            roi_x: region of interest along x-axis
+            dtype: data type of projected waveforms (and of the projection accumulator)
+        Returns:
+            data, pulse_id, is_dark
+        """
+        pulse_id, index, is_dark = self.select_pulses(
+            signal_channel, events_channel, dark_shot_event, dark_shot_filter
+        )
+
+        # averaging every image over y-axis gives the final raw waveforms
+        data = project_images(self.read_images(signal_channel, index, roi, roi_x), dtype=dtype)
+
+        return data, pulse_id, is_dark
+
+    def iter_chunks(
+        self,
+        signal_channel,
+        events_channel=None,
+        dark_shot_event=21,
+        dark_shot_filter=None,
+        roi=(None, None),
+        roi_x=(None, None),
+        chunk_size=1000,
+        dtype=float,
+    ):
+        """Read encoder data in chunks of shots with bounded memory.
+
+        Args:
+            signal_channel: data channel of encoder
+            events_channel: data channel of events
+            dark_shot_event: event number for dark shots if events_channel is present
+            dark_shot_filter: a function to return True for dark shots based on pulse_id argument
+            roi: region of interest for image projection along y-axis
+            roi_x: region of interest along x-axis
+            chunk_size: number of shots per chunk (for chunked datasets, it is rounded to a
+                multiple of dataset chunks along shots, so that every dataset chunk is read once)
+            dtype: data type of projected waveforms (and of the projection accumulator)
+        Yields:
+            pulse_id, is_dark, data of every chunk
+        """
+        pulse_id, index, is_dark = self.select_pulses(
+            signal_channel, events_channel, dark_shot_event, dark_shot_filter
+        )
+
+        for chunk, data in self.iter_rows(signal_channel, index, roi, roi_x, chunk_size, dtype):
+            if is_dark is None:
+                yield pulse_id[chunk], None, data
+            else:
+                yield pulse_id[chunk], is_dark[chunk], data
+
+    def iter_rows(
+        self,
+        channel,
+        index,
+        roi=(None, None),
+        roi_x=(None, None),
+        chunk_size=None,
+        dtype=float,
+    ):
+        """Read projected camera images of selected rows in chunks.
+
+        Args:
+            channel: data channel of a camera
+            index: sorted integer indices of images to be read
+            roi: region of interest for image projection along y-axis
+            roi_x: region of interest along x-axis
+            chunk_size: number of rows per chunk, all rows are read at once if None (for chunked
+                datasets, it is rounded to a multiple of dataset chunks along rows)
+            dtype: data type of projected waveforms (and of the projection accumulator)
+        Yields:
+            slice of index, data of every chunk
+        """
+        if chunk_size is None:
+            bounds = [0, index.size]
+        else:
+            bounds = batch_bounds(index, chunk_size, self.dataset(channel).chunks)
+
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            chunk = slice(start, stop)
+
+            # averaging every image over y-axis gives the final raw waveforms
+            images = self.read_images(channel, index[chunk], roi, roi_x)
+            yield chunk, project_images(images, dtype=dtype)
+
+
+def align_pulse_ids(pulse_ids):
+    """Align pulse ids of several channels.
+
+    bsread pulse ids are monotonic, so duplicates are found and removed in a single pass over every
+    array, and an array is sorted only if its pulse ids turn out to be not monotonic. Common pulse
+    ids of the resulting sorted unique arrays are then merged in linear time via a lookup table
+    over their span (pulse ids are dense), or via binary searches for sparse pulse ids. Zeroed
+    pulse ids are invalid and duplicated pulse ids are resolved to their first occurrences.
+
+    Args:
+        pulse_ids: list of pulse id arrays per channel
+    Returns:
+        common pulse ids, list of indices of common pulses per channel, list of alignment
+        statistics per channel with the following numbers of pulses:
+            'total': all pulses
+            'zeroed': pulses with zeroed pulse ids
+            'duplicated': repeated occurrences of the same pulse ids
+            'dropped': valid pulses with pulse ids absent in other channels
+            'gaps': places where pulse ids skip more than the smallest pulse id step
+    """
+    unique_ids = []
+    unique_indices = []
+    stats = []
+    for pid in pulse_ids:
+        index = np.flatnonzero(pid)
+        valid_pid = pid[index]
+
+        if np.any(valid_pid[1:] < valid_pid[:-1]):
+            # a stable sort keeps the first occurrences of duplicated pulse ids first
+            order = np.argsort(valid_pid, kind="stable")
+            index = index[order]
+            valid_pid = valid_pid[order]
+
+        is_first = np.ones(valid_pid.size, dtype=bool)
+        np.not_equal(valid_pid[1:], valid_pid[:-1], out=is_first[1:])
+
+        unique_ids.append(valid_pid[is_first])
+        unique_indices.append(index[is_first])
+
+        steps = np.diff(unique_ids[-1])
+        gaps = int(np.count_nonzero(steps > steps.min())) if steps.size else 0
+
+        stats.append(
+            {
+                "total": pid.size,
+                "zeroed": pid.size - valid_pid.size,
+                "duplicated": valid_pid.size - unique_ids[-1].size,
+                "gaps": gaps,
+            }
+        )
+
+    is_common = _merge_sorted(unique_ids)
+    common_ids = unique_ids[0][is_common[0]]
+
+    indices = []
+    for uindex, uis_common, channel_stats in zip(unique_indices, is_common, stats):
+        # arrays are sorted, so the selected indices are in the order of common pulse ids
+        indices.append(uindex[uis_common])
+        channel_stats["dropped"] = uindex.size - common_ids.size
+
+    return common_ids, indices, stats
+
+
+def _merge_sorted(arrays):
+    """Find values common to all sorted arrays of unique integers.
+
+    Returns:
+        list of masks of common values per array
+    """
+    if any(array.size == 0 for array in arrays):
+        return [np.zeros(array.size, dtype=bool) for array in arrays]
+
+    start = max(array[0] for array in arrays)
+    stop = min(array[-1] for array in arrays) + 1
+    if stop <= start:
+        return [np.zeros(array.size, dtype=bool) for array in arrays]
+
+    if stop - start > MAX_SPAN_FACTOR * max(array.size for array in arrays):
+        common = arrays[0]
+        for array in arrays[1:]:
+            common = common[_sorted_isin(common, array)]
+
+        return [_sorted_isin(array, common) for array in arrays]
+
+    # values within the common span, as offsets from its start
+    offsets = []
+    for array in arrays:
+        span_start, span_stop = np.searchsorted(array, (start, stop))
+        offsets.append((span_start, array[span_start:span_stop] - start))
+
+    # count occurrences of every value within the common span, a value is common if it is
+    # present in all arrays
+    counts = np.zeros(stop - start, dtype=np.min_scalar_type(len(arrays)))
+    for _, array_offsets in offsets:
+        counts[array_offsets] += 1
+
+    is_common = counts == len(arrays)
+
+    masks = []
+    for array, (span_start, array_offsets) in zip(arrays, offsets):
+        mask = np.zeros(array.size, dtype=bool)
+        mask[span_start : span_start + array_offsets.size] = is_common[array_offsets]
+        masks.append(mask)
+
+    return masks
+
+
+def _sorted_isin(values, sorted_array):
+    """Return a mask of sorted values that are present in a sorted array.
+    """
+    pos = np.searchsorted(sorted_array, values)
+    np.minimum(pos, sorted_array.size - 1, out=pos)
+
+    return sorted_array[pos] == values
+
+
+def report_alignment(filepath, alignment_stats):
+    """Log pulses that were duplicated or dropped during pulse id alignment.
+
+    Args:
+        filepath: path to the aligned file
+        alignment_stats: dictionary with alignment statistics per channel (see `align_pulse_ids`)
+    """
+    for channel, stats in alignment_stats.items():
+        if stats["duplicated"]:
+            log.warning(f"{filepath}: {stats['duplicated']} duplicated pulse id(s) in '{channel}'")
+
+        if stats["dropped"] or stats["zeroed"] or stats["gaps"]:
+            log.info(
+                f"{filepath}: '{channel}' {stats['dropped']} dropped, {stats['zeroed']} zeroed "
+                f"pulse id(s) out of {stats['total']}, {stats['gaps']} gap(s)"
+            )
+
+
+def batch_bounds(index, batch_size, chunks=None):
+    """Split selected rows of a dataset into batches.
+
+    Args:
+        index: sorted integer indices of selected rows
+        batch_size: number of rows per batch
+        chunks: (optional) chunk shape of the dataset, if present, batch boundaries are aligned
+            to chunk boundaries along rows, and batches can contain less than `batch_size` rows
+            (if not all rows are selected)
+    Returns:
+        positions of batch boundaries in index, including 0 and index.size (a single empty batch
+        if no rows are selected)
+    """
+    if index.size == 0:
+        return np.array([0, 0])
+
+    if chunks is None:
+        return np.append(np.arange(0, index.size, batch_size), index.size)
+
+    batch_rows = max(1, round(batch_size / chunks[0])) * chunks[0]
+    bounds = np.searchsorted(index, np.arange(0, index[-1] + 1, batch_rows))
+
+    # skip empty batches
+    return np.unique(np.append(bounds, index.size))
+
+
+def split_rows(index, nparts, chunks=None):
+    """Split selected rows of a dataset into contiguous parts of similar size.
+
+    Args:
+        index: sorted integer indices of selected rows
+        nparts: number of parts
+        chunks: (optional) chunk shape of the dataset, if present, part boundaries are aligned to
+            chunk boundaries along rows (the number of parts can then differ from `nparts`)
+    Returns:
+        list of index parts
+    """
+    bounds = batch_bounds(index, max(1, -(-index.size // nparts)), chunks)
+
+    return [index[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def read_rows(dataset, index, selection=()):
+    """Read selected rows of an hdf5 dataset via contiguous range reads.
+
+    h5py reads of point (fancy) selections can be much slower than reads of contiguous ranges, and
+    for chunked (compressed) datasets they can decompress the same chunk several times. Therefore,
+    rows are read per blocks of bounded size (aligned to chunks for chunked datasets) and masked in
+    memory, unless only a few rows of a block are selected. Blocks with all rows selected, and
+    blocks of contiguous datasets with only a few gaps between selected rows, are read per runs of
+    consecutive rows directly into the output array instead, as masking costs an extra copy of
+    the block.
+
+    Args:
+        dataset: hdf5 dataset
+        index: boolean mask or sorted integer indices of rows to be read
+        selection: (optional) tuple of selections along the other axes of dataset
+    Returns:
+        array with selected rows
+    """
+    if index.dtype == bool:
+        index = np.flatnonzero(index)
+
+    selection = tuple(selection)
+    row_shape = np.broadcast_to(np.empty((), dtype=dataset.dtype), dataset.shape[1:])[selection]
+    output = np.empty((index.size, *row_shape.shape), dtype=dataset.dtype)
+
+    if index.size == 0:
+        return output
+
+    if dataset.chunks is None:
+        row_nbytes = max(1, row_shape.size * dataset.dtype.itemsize)
+        block_rows = max(1, int(MAX_BLOCK_NBYTES // row_nbytes))
+    else:
+        chunk_rows = dataset.chunks[0]
+        chunk_nbytes = np.prod(dataset.chunks) * dataset.dtype.itemsize
+        block_rows = chunk_rows * max(1, int(MAX_BLOCK_NBYTES // chunk_nbytes))
+
+    block_bounds = np.flatnonzero(np.diff(index // block_rows)) + 1
+    block_bounds = np.concatenate(([0], block_bounds, [index.size]))
+    for start, stop in zip(block_bounds[:-1], block_bounds[1:]):
+        rows = index[start:stop]
+        block_size = rows[-1] - rows[0] + 1
+
+        if rows.size < MIN_BLOCK_DENSITY * block_size:
+            output[start:stop] = dataset[(rows, *selection)]
+            continue
+
+        run_bounds = np.flatnonzero(np.diff(rows) != 1) + 1
+        if run_bounds.size == 0 or (
+            dataset.chunks is None and run_bounds.size < MAX_RUNS_FRACTION * rows.size
+        ):
+            run_bounds = np.concatenate(([0], run_bounds, [rows.size]))
+            for run_start, run_stop in zip(run_bounds[:-1], run_bounds[1:]):
+                dataset.read_direct(
+                    output,
+                    source_sel=(slice(rows[run_start], rows[run_stop - 1] + 1), *selection),
+                    dest_sel=np.s_[start + run_start : start + run_stop],
+                )
+        else:
+            block = dataset[(slice(rows[0], rows[-1] + 1), *selection)]
+            output[start:stop] = block[rows - rows[0]]
+
+    return output
+
+
+def memmap_dataset(dataset):
+    """Memory-map data of an hdf5 dataset.
+
+    Only datasets with contiguous storage, which can not be compressed, and with data already
+    allocated in a file opened with a plain posix driver can be memory-mapped.
+
+    Args:
+        dataset: hdf5 dataset
+    Returns:
+        read-only memory-mapped array or None if the dataset can not be memory-mapped
+    """
+    if dataset.chunks is not None or dataset.external or dataset.dtype.hasobject:
+        return None
+
+    if dataset.file.driver not in ("sec2", "stdio") or dataset.size == 0:
+        return None
+
+    offset = dataset.id.get_offset()
+    if offset is None:
+        # storage is not allocated
+        return None
+
+    return np.memmap(
+        dataset.file.filename, dtype=dataset.dtype, mode="r", offset=offset, shape=dataset.shape
+    )
+
+
+def read_memmap_rows(array, index, selection=()):
+    """Read selected rows of a memory-mapped array.
+
+    A single run of consecutive rows is returned as a view without copying data, otherwise only
+    the selected data is copied.
+
+    Args:
+        array: memory-mapped array
+        index: boolean mask or sorted integer indices of rows to be read
+        selection: (optional) tuple of selections along the other axes of array
+    Returns:
+        array with selected rows
+    """
+    if index.dtype == bool:
+        index = np.flatnonzero(index)
+
+    if index.size > 0 and index[-1] - index[0] + 1 == index.size:
+        return array[index[0] : index[-1] + 1][(slice(None), *selection)]
+
+    return array[(index, *selection)]
+
+
+def project_images(images, dtype=float):
+    """Average camera images over y-axis.
+
+    Images are summed directly into an accumulator of `dtype`, so a copy of images converted to
+    floating point numbers is never created (data is stored as uint16 in hdf5 files).
+
+    Args:
+        images: 3D array of camera images
+        dtype: data type of the accumulator and the resulting waveforms
+    Returns:
+        projected waveforms
+    """
+    data = images.sum(axis=1, dtype=dtype)
+    data /= images.shape[1]
+
+    return data
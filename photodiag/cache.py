@@ -0,0 +1,257 @@
+import functools
+import hashlib
+import os
+import re
+import threading
+import types
+import warnings
+
+import numpy as np
+
+# file extension of cache entries
+ENTRY_EXT = ".npz"
+
+# repr of objects that is not stable between sessions
+_unstable_repr = re.compile(r" at 0x[0-9a-fA-F]+")
+
+
+class ResultCache:
+    """On-disk cache of processing results of hdf5 files.
+
+    Every entry is a single npz file with result arrays. Entries are identified by a key computed
+    from the identity of a processed file (path, size and modification time) and all parameters
+    that affect its processing. The least recently used entries are evicted once the total size
+    of the cache exceeds `max_size`.
+
+    The cache directory can be shared between processes and threads, e.g. between workers of
+    `process_eco`.
+    """
+
+    def __init__(self, path, max_size=2 ** 30):
+        """Initialize ResultCache object.
+
+        Args:
+            path: cache directory (created if it does not exist)
+            max_size: maximal total size of cache entries in bytes
+        """
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_size = max_size
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, filepath, params):
+        """Compute a cache key.
+
+        Args:
+            filepath: path to a processed file
+            params: processing parameters (any nested combination of dicts, lists, tuples, sets,
+                numpy arrays, functions, partials and objects with a stable `repr`)
+        Returns:
+            hex digest to be used as a cache key, or None if parameters can not be hashed stably
+            (results should not be cached then)
+        """
+        from . import __version__
+
+        stat = os.stat(filepath)
+
+        hasher = hashlib.sha1()
+        _hash_update(hasher, (__version__, os.path.abspath(filepath), stat.st_size))
+        _hash_update(hasher, stat.st_mtime_ns)
+        try:
+            _hash_update(hasher, params)
+        except _UnstableHashError as e:
+            warnings.warn(f"Results are not cached: {e}")
+            return None
+
+        return hasher.hexdigest()
+
+    def get(self, key):
+        """Get results from the cache.
+
+        Args:
+            key: cache key (None for results that are not cached)
+        Returns:
+            dictionary with results or None if there is no such entry
+        """
+        if key is None:
+            return None
+
+        entry = self._entry_path(key)
+
+        try:
+            with np.load(entry, allow_pickle=False) as npz:
+                results = {name: npz[name] for name in npz.files}
+            # mark entry as recently used
+            os.utime(entry)
+        except (OSError, ValueError):
+            # a missing entry, or an entry being evicted or written by another process
+            return None
+
+        for name in results.pop("__none__", ()):
+            results[str(name)] = None
+
+        return results
+
+    def put(self, key, results):
+        """Put results to the cache and evict the least recently used entries if necessary.
+
+        Args:
+            key: cache key (None for results that are not cached)
+            results: dictionary with array-like or None values
+        """
+        if key is None:
+            return
+
+        arrays = {name: value for name, value in results.items() if value is not None}
+        arrays["__none__"] = np.array(
+            [name for name, value in results.items() if value is None], dtype=str
+        )
+
+        entry = self._entry_path(key)
+        temp_entry = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        with open(temp_entry, "wb") as f:
+            np.savez(f, **arrays)
+        # atomic in case of concurrent readers or writers
+        os.replace(temp_entry, entry)
+
+        self._evict()
+
+    def clear(self):
+        """Remove all cache entries.
+        """
+        for entry in self._entries():
+            _remove(entry.path)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key + ENTRY_EXT)
+
+    def _entries(self):
+        return [
+            entry
+            for entry in os.scandir(self.path)
+            if entry.is_file() and entry.name.endswith(ENTRY_EXT)
+        ]
+
+    def _evict(self):
+        entries = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            _remove(entry_path)
+            total_size -= size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        # already removed by another process
+        pass
+
+
+class _UnstableHashError(Exception):
+    pass
+
+
+def _hash_update(hasher, obj, _seen=None):
+    """Update hasher with a stable representation of an object.
+
+    Raises _UnstableHashError for objects that can not be represented stably between sessions.
+    """
+    if _seen is None:
+        _seen = set()
+
+    if isinstance(obj, np.ndarray):
+        hasher.update(f"ndarray{obj.dtype.str}{obj.shape}".encode())
+        hasher.update(np.ascontiguousarray(obj).tobytes())
+
+    elif isinstance(obj, dict):
+        hasher.update(b"dict")
+        for key in sorted(obj, key=repr):
+            _hash_update(hasher, key, _seen)
+            _hash_update(hasher, obj[key], _seen)
+
+    elif isinstance(obj, (list, tuple)):
+        hasher.update(f"{type(obj).__name__}{len(obj)}".encode())
+        for item in obj:
+            _hash_update(hasher, item, _seen)
+
+    elif isinstance(obj, (set, frozenset)):
+        # iteration order of sets can differ between sessions
+        hasher.update(f"{type(obj).__name__}{len(obj)}".encode())
+        for item in sorted(obj, key=repr):
+            _hash_update(hasher, item, _seen)
+
+    elif isinstance(obj, functools.partial):
+        hasher.update(b"partial")
+        _hash_update(hasher, obj.func, _seen)
+        _hash_update(hasher, obj.args, _seen)
+        _hash_update(hasher, obj.keywords, _seen)
+
+    elif isinstance(obj, types.MethodType):
+        hasher.update(b"method")
+        _hash_update(hasher, obj.__func__, _seen)
+        _hash_update(hasher, obj.__self__, _seen)
+
+    elif isinstance(obj, types.FunctionType):
+        # functions (e.g. dark shot filters) are identified by their code, default arguments,
+        # values captured in closures and referenced global variables, as their repr contains
+        # a memory address
+        hasher.update(f"function{obj.__module__}.{obj.__qualname__}".encode())
+        if id(obj) in _seen:
+            # recursive reference
+            return
+        _seen.add(id(obj))
+
+        _hash_code(hasher, obj.__code__, _seen)
+        _hash_update(hasher, obj.__defaults__, _seen)
+        _hash_update(hasher, obj.__kwdefaults__, _seen)
+
+        for cell in obj.__closure__ or ():
+            try:
+                _hash_update(hasher, cell.cell_contents, _seen)
+            except ValueError:
+                # an empty cell
+                hasher.update(b"empty cell")
+
+        for name in sorted(_code_names(obj.__code__)):
+            if name in obj.__globals__:
+                _hash_update(hasher, name, _seen)
+                _hash_update(hasher, obj.__globals__[name], _seen)
+
+    else:
+        obj_repr = repr(obj)
+        if _unstable_repr.search(obj_repr):
+            raise _UnstableHashError(f"{obj_repr} can not be hashed stably")
+        hasher.update(f"{type(obj).__name__}{obj_repr}".encode())
+
+
+def _hash_code(hasher, code, _seen):
+    hasher.update(code.co_code)
+    _hash_update(hasher, code.co_names, _seen)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            # nested functions, lambdas and comprehensions
+            _hash_code(hasher, const, _seen)
+        else:
+            _hash_update(hasher, const, _seen)
+
+
+def _code_names(code):
+    """Return names of global variables and attributes referenced by code and nested code.
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_names(const)
+
+    return names
@@ -0,0 +1,162 @@
+from .bsread_reader import RDCC_NBYTES, BsreadReader, split_rows
+from .executor import imap_method, map_method
+from .utils import concatenate_results, read_eco_scan
+
+
+class EncoderMixin:
+    """Processing of eco scans and of bsread hdf5 files split between workers, shared by
+    encoders.
+
+    By default, data is read from `signal_channel` within `roi` and `roi_x`, encoders with other
+    data layouts override `_select_pulses`, `_signal_dataset` and `_iter_rows`.
+    """
+
+    def iter_eco(
+        self,
+        filepath,
+        nproc=1,
+        debug=False,
+        memmap=False,
+        rdcc_nbytes=RDCC_NBYTES,
+        backend="process",
+    ):
+        """Process encoder data from eco scan file, yielding results of every scan step as soon as
+        it is processed.
+
+        Args:
+            filepath: json eco scan file to be processed
+            nproc: number of workers to use (ignored if executor is present)
+            debug: return debug data
+            memmap: memory-map contiguous uncompressed datasets instead of reading them
+            rdcc_nbytes: size of the hdf5 raw data chunk cache per dataset in bytes
+            backend: {'process', 'thread'} type of workers (ignored if executor is present)
+        Yields:
+            results of scan steps in order of completion, as in `process_eco`, with additional
+                'step': index of the scan step
+                'step_time': processing time of the scan step in s
+                'progress': fraction of processed scan steps
+        """
+        if self.events_channel or self.dark_shot_filter:
+            pass
+        else:
+            if self._background is None:
+                raise Exception("Background calibration is not found")
+
+        scan_pos_fs, bsread_files = read_eco_scan(filepath)
+
+        steps = imap_method(
+            self,
+            "process_hdf5",
+            bsread_files,
+            nproc,
+            backend,
+            debug=debug,
+            memmap=memmap,
+            rdcc_nbytes=rdcc_nbytes,
+        )
+
+        for n_done, (i, step_output, step_time) in enumerate(steps, start=1):
+            step_output["scan_pos_fs"] = scan_pos_fs[i]
+            step_output["step"] = i
+            step_output["step_time"] = step_time
+            step_output["progress"] = n_done / len(bsread_files)
+            yield step_output
+
+    def _cache_params(self):
+        """Return all parameters that affect results of `process_hdf5`.
+        """
+        params = {"class": type(self).__name__, **vars(self)}
+        del params["cache"]
+        del params["executor"]
+        del params["pix_per_fs"]
+
+        return params
+
+    def _select_pulses(self, reader):
+        """Select valid pulses of the encoder data channel.
+
+        Args:
+            reader: BsreadReader of a bsread hdf5 file to read data from
+        Returns:
+            pulse_id, index of valid pulses, is_dark
+        """
+        return reader.select_pulses(
+            self.signal_channel, self.events_channel, self.dark_shot_event, self.dark_shot_filter
+        )
+
+    def _signal_dataset(self, reader):
+        """Return data dataset of the encoder data channel.
+        """
+        return reader.dataset(self.signal_channel)
+
+    def _iter_rows(self, reader, index, chunk_size):
+        """Read encoder data of selected shots in chunks.
+
+        Args:
+            reader: BsreadReader of a bsread hdf5 file to read data from
+            index: sorted integer indices of shots to be read
+            chunk_size: number of shots per chunk, or None
+        Yields:
+            slice of index, data of every chunk
+        """
+        return reader.iter_rows(
+            self.signal_channel, index, self.roi, self.roi_x, chunk_size=chunk_size
+        )
+
+    def _process_shot_ranges(self, reader, nproc, backend, debug, chunk_size, memmap, rdcc_nbytes):
+        """Process encoder data from bsread hdf5 file split between workers.
+
+        Args:
+            reader: BsreadReader of a bsread hdf5 file to read data from
+            nproc: number of workers to use
+            backend: {'process', 'thread'} type of workers
+            debug: return debug data
+            chunk_size: number of shots per chunk within every worker, or None
+            memmap: memory-map contiguous uncompressed datasets instead of reading them
+            rdcc_nbytes: size of the hdf5 raw data chunk cache per dataset in bytes
+        Returns:
+            results of processing, pulse_id, is_dark
+        """
+        pulse_id, index, is_dark = self._select_pulses(reader)
+        chunks = self._signal_dataset(reader).chunks
+        worker_kwargs = dict(
+            filepath=reader.filepath, chunk_size=chunk_size, memmap=memmap, rdcc_nbytes=rdcc_nbytes
+        )
+
+        self._calibrate_shot_ranges(index, is_dark, chunks, nproc, backend, worker_kwargs)
+
+        # a file without valid shots is still processed as a single empty range
+        outputs = map_method(
+            self,
+            "_process_shots",
+            split_rows(index, nproc, chunks) or [index],
+            nproc,
+            backend,
+            debug=debug,
+            **worker_kwargs,
+        )
+
+        return concatenate_results(outputs), pulse_id, is_dark
+
+    def _calibrate_shot_ranges(self, index, is_dark, chunks, nproc, backend, worker_kwargs):
+        """Prepare background calibration before shots are processed in workers.
+
+        Args:
+            index: sorted integer indices of valid shots
+            is_dark: dark shots among valid shots, or None
+            chunks: chunk shape of the encoder dataset, or None
+            nproc: number of workers to use
+            backend: {'process', 'thread'} type of workers
+            worker_kwargs: keyword arguments to read data in workers
+        """
+        if self._background is None:
+            raise Exception("Background calibration is not found")
+
+    def _process_shots(self, index, filepath, debug, chunk_size, memmap, rdcc_nbytes):
+        """Process encoder data of selected shots (runs in a worker).
+        """
+        with BsreadReader(filepath, memmap=memmap, rdcc_nbytes=rdcc_nbytes) as reader:
+            chunks = self._iter_rows(reader, index, chunk_size)
+            outputs = [self.process(data, debug=debug) for _, data in chunks]
+
+        return concatenate_results(outputs)
@@ -0,0 +1,248 @@
+import copy
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from multiprocessing import Pool
+
+from .utils import SCRATCH_DIR, imap_via_scratch, map_via_scratch
+
+backends = ["process", "thread"]
+
+# number of objects (e.g. encoders with different calibrations) kept by every worker process
+WORKER_OBJECTS_SIZE = 8
+
+# objects broadcast to the current worker process, {state key: object}
+_worker_objects = {}
+
+
+class Executor:
+    """Long-lived pool of workers to be attached to or shared between encoders.
+
+    Workers are started once, so that consecutive calls of `process_eco` do not pay the pool
+    startup cost.
+
+    With the 'process' backend, the state of an encoder (e.g. background calibration) is broadcast
+    to the worker processes via a scratch file only once per distinct state, and every worker
+    keeps the last WORKER_OBJECTS_SIZE received objects.
+
+    With the 'thread' backend, workers are threads of the current process, so neither encoders
+    nor results are copied between processes. This pays off for workloads that release the GIL
+    (numpy/scipy kernels, reads of memory-mapped datasets), and it also works where forking is
+    problematic, e.g. in a Bokeh server process.
+    """
+
+    def __init__(self, nproc=None, backend="process"):
+        """Initialize Executor object.
+
+        Args:
+            nproc: number of workers to use (all available cpus if None)
+            backend: {'process', 'thread'} type of workers
+        """
+        if backend not in backends:
+            raise ValueError(f"Unknown executor backend '{backend}'")
+
+        self.nproc = nproc or os.cpu_count()
+        self.backend = backend
+
+        if backend == "thread":
+            self._pool = ThreadPoolExecutor(max_workers=self.nproc)
+        else:
+            self._scratch = tempfile.TemporaryDirectory(dir=SCRATCH_DIR)
+            self._states = {}
+            self._pool = Pool(processes=self.nproc, initializer=_init_worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def map(self, obj, method, iterable, **kwargs):
+        """Call a method of an object for every item of an iterable in the workers.
+
+        Args:
+            obj: object (e.g. an encoder) that is broadcast to the workers
+            method: name of the method to be called, returning a dictionary with results
+            iterable: items to be processed
+            **kwargs: keyword arguments passed to the method
+        Returns:
+            list of results
+        """
+        if self.backend == "thread":
+            return _thread_map(self._pool, obj, method, iterable, **kwargs)
+
+        key, path = self._broadcast(obj)
+
+        return map_via_scratch(
+            self._pool, partial(_call_method, key, path, method, **kwargs), iterable
+        )
+
+    def imap_unordered(self, obj, method, iterable, **kwargs):
+        """Call a method of an object for every item of an iterable in the workers, yielding
+        results in order of completion.
+
+        Args:
+            obj: object (e.g. an encoder) that is broadcast to the workers
+            method: name of the method to be called, returning a dictionary with results
+            iterable: items to be processed
+            **kwargs: keyword arguments passed to the method
+        Yields:
+            index of an item in iterable, its result, processing time of the item in s
+        """
+        if self.backend == "thread":
+            yield from _thread_imap_unordered(self._pool, obj, method, iterable, **kwargs)
+            return
+
+        key, path = self._broadcast(obj)
+
+        yield from imap_via_scratch(
+            self._pool, partial(_call_method, key, path, method, **kwargs), iterable
+        )
+
+    def close(self):
+        """Stop the workers and remove broadcast scratch files.
+        """
+        if self.backend == "thread":
+            self._pool.shutdown()
+        else:
+            self._pool.close()
+            self._pool.join()
+            self._scratch.cleanup()
+            self._states.clear()
+
+    def _broadcast(self, obj):
+        """Save the current state of an object to a scratch file, unless it is already there.
+        """
+        obj = copy.copy(obj)
+        if getattr(obj, "executor", None) is not None:
+            # the pool itself can not be passed to the worker processes
+            obj.executor = None
+
+        payload = pickle.dumps(obj)
+        key = hashlib.sha1(payload).hexdigest()
+
+        if key not in self._states:
+            path = os.path.join(self._scratch.name, key + ".pickle")
+            with open(path, "wb") as f:
+                f.write(payload)
+            self._states[key] = path
+
+        return key, self._states[key]
+
+
+def map_method(obj, method, iterable, nproc=1, backend="process", **kwargs):
+    """Call a method of an object for every item of an iterable in workers.
+
+    The executor attached to the object is used if present, otherwise a pool of `nproc` workers
+    is started for this call only.
+
+    Args:
+        obj: object (e.g. an encoder), optionally with an `executor` attribute
+        method: name of the method to be called, returning a dictionary with results
+        iterable: items to be processed
+        nproc: number of workers to use (ignored if executor is present)
+        backend: {'process', 'thread'} type of workers (ignored if executor is present)
+        **kwargs: keyword arguments passed to the method
+    Returns:
+        list of results
+    """
+    executor = getattr(obj, "executor", None)
+    if executor is not None:
+        return executor.map(obj, method, iterable, **kwargs)
+
+    if backend not in backends:
+        raise ValueError(f"Unknown executor backend '{backend}'")
+
+    if backend == "thread":
+        with ThreadPoolExecutor(max_workers=nproc) as pool:
+            return _thread_map(pool, obj, method, iterable, **kwargs)
+
+    with Pool(processes=nproc) as pool:
+        return map_via_scratch(pool, partial(getattr(obj, method), **kwargs), iterable)
+
+
+def imap_method(obj, method, iterable, nproc=1, backend="process", **kwargs):
+    """Call a method of an object for every item of an iterable in workers, yielding results in
+    order of completion.
+
+    The executor attached to the object is used if present, otherwise a pool of `nproc` workers
+    is started for the lifetime of the generator.
+
+    Args:
+        obj: object (e.g. an encoder), optionally with an `executor` attribute
+        method: name of the method to be called, returning a dictionary with results
+        iterable: items to be processed
+        nproc: number of workers to use (ignored if executor is present)
+        backend: {'process', 'thread'} type of workers (ignored if executor is present)
+        **kwargs: keyword arguments passed to the method
+    Yields:
+        index of an item in iterable, its result, processing time of the item in s
+    """
+    executor = getattr(obj, "executor", None)
+    if executor is not None:
+        yield from executor.imap_unordered(obj, method, iterable, **kwargs)
+        return
+
+    if backend not in backends:
+        raise ValueError(f"Unknown executor backend '{backend}'")
+
+    if backend == "thread":
+        with ThreadPoolExecutor(max_workers=nproc) as pool:
+            yield from _thread_imap_unordered(pool, obj, method, iterable, **kwargs)
+        return
+
+    with Pool(processes=nproc) as pool:
+        yield from imap_via_scratch(pool, partial(getattr(obj, method), **kwargs), iterable)
+
+
+def _thread_map(pool, obj, method, iterable, **kwargs):
+    return list(pool.map(partial(_call_copy, obj, method, **kwargs), iterable))
+
+
+def _thread_imap_unordered(pool, obj, method, iterable, **kwargs):
+    func = partial(_call_copy_timed, obj, method, **kwargs)
+    futures = {pool.submit(func, item): i for i, item in enumerate(iterable)}
+
+    try:
+        for future in as_completed(futures):
+            result, process_time = future.result()
+            yield futures[future], result, process_time
+    finally:
+        # do not process the remaining items if the generator is closed early
+        for future in futures:
+            future.cancel()
+
+
+def _call_copy(obj, method, *args, **kwargs):
+    # a shallow copy isolates attributes that are set during processing (e.g. a background
+    # calibrated on a processed file) from concurrent calls in other threads
+    return getattr(copy.copy(obj), method)(*args, **kwargs)
+
+
+def _call_copy_timed(obj, method, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = _call_copy(obj, method, *args, **kwargs)
+
+    return result, time.perf_counter() - start_time
+
+
+def _init_worker():
+    _worker_objects.clear()
+
+
+def _call_method(key, path, method, *args, **kwargs):
+    obj = _worker_objects.get(key)
+    if obj is None:
+        with open(path, "rb") as f:
+            obj = pickle.load(f)
+
+        if len(_worker_objects) >= WORKER_OBJECTS_SIZE:
+            # drop the oldest object
+            del _worker_objects[next(iter(_worker_objects))]
+        _worker_objects[key] = obj
+
+    return getattr(obj, method)(*args, **kwargs)
@@ -10,7 +10,16 @@ import numpy as np
 import pandas as pd
 from scipy.optimize import curve_fit
 
+from photodiag.bsread_reader import (
+    RDCC_NBYTES,
+    align_pulse_ids,
+    read_rows,
+    report_alignment,
+    split_rows,
+)
+from photodiag.executor import map_method
 from photodiag.spectrometer import Spectrometer
+from photodiag.utils import concatenate_results
 
 log = logging.getLogger(__name__)
 
@@ -19,7 +28,7 @@ class PalmSetup:
     """Class describing the photon arrival and length monitor (PALM) setup.
     """
 
-    def __init__(self, channels, noise_range, energy_range):
+    def __init__(self, channels, noise_range, energy_range, cache=None):
         """Initialize PALM setup object.
 
         For the electron time of flight (eTOF) spectrometers the following notation is used:
@@ -31,10 +40,12 @@ class PalmSetup:
                 the same range will be applied for all spectrometers)
             energy_range: energy interpolation points (eV) to be used for convering
                 spectrometer waveforms from 'time of flight' into 'energy' domain
+            cache: (optional) ResultCache to store results of processed hdf5 files
         """
         self.channels = channels
         self.etofs = {"0": Spectrometer(noise_range), "1": Spectrometer(noise_range)}
         self.energy_range = energy_range
+        self.cache = cache
 
         self.thz_calib_data = pd.DataFrame(
             {
@@ -79,14 +90,21 @@ class PalmSetup:
                     self.xfel_energy - self.binding_energy - get_energy_from_filename(entry.name)
                 )
 
+                etof_paths = {}
                 for etof_key in calibrated_etofs:
                     etof = self.etofs[etof_key]
                     if not overwrite and energy in etof.calib_data.index:
                         continue
 
-                    _, calib_waveforms = get_tags_and_data(entry.path, self.channels[etof_key])
+                    etof_paths[etof_key] = self.channels[etof_key]
 
-                    etof.add_calibration_point(energy, calib_waveforms)
+                if not etof_paths:
+                    continue
+
+                _, calib_waveforms = load_palm_file(entry.path, etof_paths)
+
+                for etof_key, etof_calib_waveforms in calib_waveforms.items():
+                    self.etofs[etof_key].add_calibration_point(energy, etof_calib_waveforms)
 
         calib_results = {}
         for etof_key in self.etofs:
@@ -108,14 +126,15 @@ class PalmSetup:
         for scan_file, scan_value in zip(scan_files, scan_values):
             energy = scan_value[0]
             try:
-                _, calib_waveforms0 = get_tags_and_data(scan_file, self.channels["0"])
-                _, calib_waveforms1 = get_tags_and_data(scan_file, self.channels["1"])
+                _, calib_waveforms = load_palm_file(
+                    scan_file, {"0": self.channels["0"], "1": self.channels["1"]}
+                )
             except Exception as e:
                 log.warning(e)
             else:
                 eff_bind_en = self.binding_energy + (self.zero_drift_tube - 1000 * energy)
-                self.etofs["0"].add_calibration_point(eff_bind_en, calib_waveforms0)
-                self.etofs["1"].add_calibration_point(eff_bind_en, calib_waveforms1)
+                self.etofs["0"].add_calibration_point(eff_bind_en, calib_waveforms["0"])
+                self.etofs["1"].add_calibration_point(eff_bind_en, calib_waveforms["1"])
 
         calib_results = {}
         for etof_key in self.etofs:
@@ -169,6 +188,20 @@ class PalmSetup:
                 data, self.energy_range, jacobian=jacobian, noise_thr=noise_thr
             )
 
+        return self._analyse(prep_data, method=method, debug=debug, peak=peak)
+
+    def _analyse(self, prep_data, method="xcorr", debug=False, peak="max"):
+        """Analyse PALM data converted into 'energy' domain.
+
+        Args:
+            prep_data: dictionary with converted waveforms from streaked and non-streaked
+                spectrometers
+            method: (optional) currently, only one method is available {'xcorr' (default), 'deconv'}
+            debug: (optional) return debug data
+
+        Returns:
+            pulse lengths and arrival times per pulse
+        """
         if method == "xcorr":
             results = self._cross_corr_analysis(prep_data, debug=debug, peak=peak)
 
@@ -249,25 +282,134 @@ class PalmSetup:
             self.thz_motor_name = pickle.load(f)
             log.info("Load etof calibration from a file: %s", filepath)
 
-    def process_hdf5_file(self, filepath, debug=False):
+    def process_hdf5_file(self, filepath, debug=False, nproc=1, backend="process"):
         """Load data for all registered spectrometers from an hdf5 file. This method is to be
         changed in order to adapt to a format of PALM data files in the future.
 
         Args:
             filepath: file path to be loaded
+            debug: (optional) return debug data
+            nproc: (optional) if > 1, split shots of the file in contiguous ranges between `nproc`
+                workers
+            backend: (optional) {'process' (default), 'thread'} type of workers, threads avoid
+                copying of data between processes and can be used where forking is problematic
 
         Returns:
             tuple of tags and the corresponding results in a dictionary
+            (results are taken from/put to the cache if it is present and `debug` is False)
         """
-        data_raw = {}
-        for etof_key in self.etofs:
-            tags, data = get_tags_and_data(filepath, self.channels[etof_key])
-            data_raw[etof_key] = data
-            # data_raw[etof_key] = np.expand_dims(data[1, :], axis=0)
+        if self.cache is not None and not debug:
+            cache_key = self.cache.key(filepath, self._cache_params())
+            results = self.cache.get(cache_key)
+            if results is not None:
+                return results["tags"], results["delays"], results["pulse_lengths"]
+
+        if nproc > 1:
+            tags, *results = self._process_shot_ranges(filepath, nproc, backend, debug)
+        else:
+            tags, data = self._load_hdf5_file(filepath)
+            results = self._analyse(data, debug=debug)
+
+        if self.cache is not None and not debug:
+            delays, pulse_lengths = results
+            self.cache.put(
+                cache_key, {"tags": tags, "delays": delays, "pulse_lengths": pulse_lengths}
+            )
 
-        results = self.process(data_raw, debug=debug)
         return (tags, *results)
 
+    def _load_hdf5_file(self, filepath, rows=slice(None)):
+        """Load data for all registered spectrometers from an hdf5 file and convert it into
+        'energy' domain.
+
+        Args:
+            filepath: file path to be loaded
+            rows: (optional) slice of shots to be loaded
+
+        Returns:
+            tags and a dictionary with converted data per eTOF spectrometer key
+        """
+        tags, data = load_palm_file(
+            filepath, {etof_key: self.channels[etof_key] for etof_key in self.etofs}, rows=rows
+        )
+
+        # replace raw waveforms by converted ones one by one, so that the raw data of each
+        # spectrometer is released as soon as it is converted
+        for etof_key in data:
+            data[etof_key] = self.etofs[etof_key].convert(
+                data[etof_key], self.energy_range, noise_thr=0
+            )
+
+        return tags, data
+
+    def _process_shot_ranges(self, filepath, nproc, backend, debug):
+        """Process PALM data from an hdf5 file split between workers.
+
+        Args:
+            filepath: file path to be loaded
+            nproc: number of workers to use
+            backend: {'process', 'thread'} type of workers
+            debug: return debug data
+
+        Returns:
+            tags, delays, pulse lengths (and debug data if `debug` is True)
+        """
+        n_shots = palm_file_shots(
+            filepath, {etof_key: self.channels[etof_key] for etof_key in self.etofs}
+        )
+        ranges = [(part[0], part[-1] + 1) for part in split_rows(np.arange(n_shots), nproc)]
+
+        outputs = map_method(
+            self,
+            "_process_shots",
+            ranges or [(0, 0)],
+            nproc,
+            backend,
+            filepath=filepath,
+            debug=debug,
+        )
+        output = concatenate_results(outputs)
+
+        if debug:
+            input_data = {etof_key: output[f"input_data_{etof_key}"] for etof_key in self.etofs}
+            corr_results = (output["corr_res_uncut"], output["corr_results"])
+            debug_data = (input_data, self._lags(), *corr_results)
+            return output["tags"], output["delays"], output["pulse_lengths"], debug_data
+
+        return output["tags"], output["delays"], output["pulse_lengths"]
+
+    def _process_shots(self, rows, filepath, debug):
+        """Process PALM data of a range of shots from an hdf5 file (runs in a worker).
+        """
+        tags, data = self._load_hdf5_file(filepath, rows=slice(*rows))
+        delays, pulse_lengths, *debug_data = self._analyse(data, debug=debug)
+
+        output = {"tags": np.asarray(tags), "delays": delays, "pulse_lengths": pulse_lengths}
+        if debug:
+            input_data, _, corr_res_uncut, corr_results = debug_data[0]
+            for etof_key, etof_data in input_data.items():
+                output[f"input_data_{etof_key}"] = etof_data
+            output["corr_res_uncut"] = corr_res_uncut
+            output["corr_results"] = corr_results
+
+        return output
+
+    def _cache_params(self):
+        """Return all parameters that affect results of `process_hdf5_file`.
+        """
+        etofs = {
+            etof_key: (
+                etof.calib_a,
+                etof.calib_b,
+                etof.calib_t0,
+                etof.internal_time_bins,
+                etof.calib_data["noise_std"].values,
+            )
+            for etof_key, etof in self.etofs.items()
+        }
+
+        return {"channels": self.channels, "energy_range": self.energy_range, "etofs": etofs}
+
     def _cross_corr_analysis(self, input_data, debug=False, peak="max"):
         """Perform analysis to determine arrival times via cross correlation.
 
@@ -288,10 +430,11 @@ class PalmSetup:
         for i, (x, y) in enumerate(zip(data_ref, data_str)):
             corr_results[i, :] = np.correlate(x, y, mode="same")
 
-        corr_res_uncut = corr_results.copy()
+        if debug:
+            corr_res_uncut = corr_results.copy()
         corr_results = self._truncate_highest_peak(corr_results, 0)
 
-        lags = self.energy_range - self.energy_range[int(self.energy_range.size / 2)]
+        lags = self._lags()
 
         if peak == "com":
             delays, _ = self._peak_params(lags, corr_results)
@@ -304,6 +447,11 @@ class PalmSetup:
             return delays, pulse_lengths, (input_data, lags, corr_res_uncut, corr_results)
         return delays, pulse_lengths
 
+    def _lags(self):
+        """Return cross-correlation lags in 'energy' domain.
+        """
+        return self.energy_range - self.energy_range[int(self.energy_range.size / 2)]
+
     def _deconvolution_analysis(self, input_data, iterations=200, debug=False):
         """Perform analysis to determine temporal profile of photon pulses.
 
@@ -382,7 +530,9 @@ class PalmSetup:
         if y.ndim == 1:
             test_fun(y)
         else:
-            np.apply_along_axis(test_fun, 1, y)
+            # truncate rows in place (np.apply_along_axis would allocate an output array)
+            for y_1d in y:
+                test_fun(y_1d)
 
         return y
 
@@ -420,7 +570,9 @@ class PalmSetup:
         if y.ndim == 1:
             test_fun(y)
         else:
-            np.apply_along_axis(test_fun, 1, y)
+            # truncate rows in place (np.apply_along_axis would allocate an output array)
+            for y_1d in y:
+                test_fun(y_1d)
 
         return y
 
@@ -478,45 +630,228 @@ def get_tags_and_data(filepath, etof_path):
     Returns:
         tags and data
     """
-    # TODO: for the E1130 pylint issue, see
-    # https://github.com/PyCQA/pylint/issues/2436
+    tags, data = load_palm_file(filepath, {etof_path: etof_path})
+    return tags, data[etof_path]
+
+
+# known layouts of PALM data files as (tags location, data location), where '{}' is substituted
+# with an eTOF data path, and tags are not present if their location is None (tags stored per
+# eTOF data path are pulse ids to be aligned between spectrometers)
+palm_file_layouts = [
+    ("/pulseId", "/{}"),
+    ("/scan 1/SLAAR21-LMOT-M552:MOT.VAL", "/scan 1/{} averager"),
+    ("/data/{}/pulse_id", "/data/{}/data"),
+    ("/pulse_id", "/{}/data"),
+    (None, "/{}"),
+]
+
+# layouts of the last loaded files per folder, files in the same folder usually share a layout
+_palm_folder_layouts = {}
+
+
+def load_palm_file(filepath, etof_paths, rdcc_nbytes=RDCC_NBYTES, rows=slice(None)):
+    """Read PALM waveforms of several eTOF spectrometers from an hdf5 file in one pass.
+
+    The file is opened only once, and the layout found in it is tried first for the following
+    files from the same folder. Pulse ids stored per eTOF channel are aligned, so that only shots
+    present in all channels are read.
+
+    Args:
+        filepath: path to an hdf5 file
+        etof_paths: dictionary with locations of data in hdf5 file per eTOF spectrometer key
+        rdcc_nbytes: size of the hdf5 raw data chunk cache per dataset in bytes
+        rows: (optional) slice of shots to be read
+
+    Returns:
+        tags and a dictionary with data per eTOF spectrometer key
+    """
+    with h5py.File(filepath, "r", rdcc_nbytes=rdcc_nbytes) as h5f:
+        tags, data_datasets = _locate_palm_datasets(h5f, filepath, etof_paths)
+        tags, indices = _select_palm_shots(tags, data_datasets)
+
+        tags = [] if tags is None else tags[rows]
+        data = {
+            etof_key: _read_negated(data_dataset, indices[etof_key][rows])
+            for etof_key, data_dataset in data_datasets.items()
+        }
+
+    return tags, data
+
+
+def palm_file_shots(filepath, etof_paths):
+    """Return the number of shots in a PALM hdf5 file.
+
+    Args:
+        filepath: path to an hdf5 file
+        etof_paths: dictionary with locations of data in hdf5 file per eTOF spectrometer key
+
+    Returns:
+        number of shots
+    """
+    with h5py.File(filepath, "r") as h5f:
+        _, indices = _select_palm_shots(*_locate_palm_datasets(h5f, filepath, etof_paths))
+        n_shots = len(next(iter(indices.values())))
+
+    return n_shots
+
+
+def _locate_palm_datasets(h5f, filepath, etof_paths):
+    """Find tags and data datasets of eTOF spectrometers in an open hdf5 file.
+
+    The layout found in the file is tried first for the following files from the same folder.
+
+    Returns:
+        tags (None if not present, a dataset shared by all eTOF spectrometers or a dictionary with
+        pulse id datasets per eTOF spectrometer key) and a dictionary with data datasets per eTOF
+        spectrometer key
+    """
+    folder = os.path.dirname(os.path.abspath(filepath))
+    layouts = palm_file_layouts
+    if folder in _palm_folder_layouts:
+        layouts = [_palm_folder_layouts[folder], *palm_file_layouts]
+
+    for tags_location, data_location in layouts:
+        if tags_location is None:
+            tags = None
+        elif "{}" in tags_location:
+            tags = {
+                etof_key: h5f.get(tags_location.format(etof_path))
+                for etof_key, etof_path in etof_paths.items()
+            }
+            if not all(isinstance(dataset, h5py.Dataset) for dataset in tags.values()):
+                continue
+        else:
+            tags = h5f.get(tags_location)
+            if not isinstance(tags, h5py.Dataset):
+                continue
+
+        data_datasets = {}
+        for etof_key, etof_path in etof_paths.items():
+            data_dataset = h5f.get(data_location.format(etof_path))
+            if not isinstance(data_dataset, h5py.Dataset):
+                break
+            data_datasets[etof_key] = data_dataset
+        else:
+            if tags_location is not None:
+                # the last layout fits too many files to be remembered
+                _palm_folder_layouts[folder] = (tags_location, data_location)
+
+            return tags, data_datasets
+
+    raise Exception(f"Could not locate data in {filepath}")
+
+
+def _select_palm_shots(tags, data_datasets):
+    """Return tags and indices of shots to be read per eTOF spectrometer key.
+
+    Pulse ids stored per eTOF spectrometer are aligned in the same way as channels of bsread
+    files, otherwise shots common to all data datasets are selected in file order.
+    """
+    if isinstance(tags, dict):
+        filepath = next(iter(tags.values())).file.filename
+        tags, indices, stats = align_pulse_ids([tags[etof_key][:] for etof_key in data_datasets])
+        report_alignment(filepath, dict(zip(data_datasets, stats)))
+        return tags, dict(zip(data_datasets, indices))
+
+    n_shots = min(len(data_dataset) for data_dataset in data_datasets.values())
+    if tags is not None:
+        tags = tags[:]
+
+    return tags, {etof_key: np.arange(n_shots) for etof_key in data_datasets}
+
+
+def _read_negated(dataset, index):
+    """Read rows of an hdf5 dataset and negate their values.
+
+    Rows are always read in file order and then placed in the order of index (aligned pulse ids
+    of a channel can be stored out of order). Data is negated in place, so that a second
+    full-size array is not allocated for rows stored in order.
+    """
+    if np.any(index[1:] < index[:-1]):
+        order = np.argsort(index)
+        data = np.empty((index.size, *dataset.shape[1:]), dtype=dataset.dtype)
+        data[order] = read_rows(dataset, index[order])
+    else:
+        data = read_rows(dataset, index)
+
+    np.negative(data, out=data)
+
+    return data
+
+
+# columns of PALM results files
+palm_result_columns = ["pulse_id", "pulse_delay", "pulse_length"]
+
+# save_palm_results: maximal number of pulses per hdf5 chunk
+RESULTS_CHUNK_SIZE = 2 ** 16
+
+
+def save_palm_results(filepath, run, tags, delays, lengths):
+    """Save PALM results of a run to an hdf5 file.
+
+    Results of every run are stored in a separate group named after the run, with a chunked and
+    compressed dataset per column, so that results of many runs can be appended to a single file.
+    Results of a run that is already present in the file are overwritten (hdf5 does not reclaim
+    the space of overwritten results).
+
+    Args:
+        filepath: path to an hdf5 file (created if it does not exist)
+        run: name of the run, e.g. a name of a processed file
+        tags: pulse ids
+        delays: pulse delays
+        lengths: pulse lengths
+    """
+    columns = dict(zip(palm_result_columns, (tags, delays, lengths)))
+    columns = {name: np.asarray(values) for name, values in columns.items()}
+
+    if len({values.size for values in columns.values()}) != 1:
+        raise ValueError("Pulse ids, delays and lengths should be of the same length")
+
+    with h5py.File(filepath, "a") as h5f:
+        if run in h5f:
+            del h5f[run]
+
+        group = h5f.create_group(run)
+        for name, values in columns.items():
+            if values.size:
+                group.create_dataset(
+                    name,
+                    data=values,
+                    chunks=(min(values.size, RESULTS_CHUNK_SIZE),),
+                    compression="gzip",
+                    shuffle=True,
+                )
+            else:
+                group.create_dataset(name, data=values)
+
+
+def load_palm_results(filepath, runs=None):
+    """Load PALM results from an hdf5 file.
+
+    Args:
+        filepath: path to an hdf5 file with PALM results
+        runs: (optional) list of runs to load, all runs by default
+
+    Returns:
+        DataFrame with PALM results and the corresponding run names
+    """
     with h5py.File(filepath, "r") as h5f:
-        try:
-            tags = h5f["/pulseId"][:]
-            data = -h5f[f"/{etof_path}"][:]  # pylint: disable=E1130
-            return tags, data
-        except (KeyError, AttributeError):
-            pass
-
-        try:
-            tags = h5f["/scan 1/SLAAR21-LMOT-M552:MOT.VAL"][:]
-            data = -h5f[f"/scan 1/{etof_path} averager"][:]  # pylint: disable=E1130
-            return tags, data
-        except (KeyError, AttributeError):
-            pass
-
-        try:
-            tags = h5f[f"/data/{etof_path}/pulse_id"][:]
-            data = -h5f[f"/data/{etof_path}/data"][:]  # pylint: disable=E1130
-            return tags, data
-        except (KeyError, AttributeError):
-            pass
-
-        try:
-            tags = h5f["/pulse_id"][:]
-            data = -h5f[f"/{etof_path}/data"][:]  # pylint: disable=E1130
-            return tags, data
-        except (KeyError, AttributeError):
-            pass
-
-        try:
-            tags = []
-            data = -h5f[f"/{etof_path}"][:]  # pylint: disable=E1130
-            return tags, data
-        except (KeyError, AttributeError):
-            pass
-
-        raise Exception(f"Could not locate data in {filepath}")
+        if runs is None:
+            runs = list(h5f)
+
+        dfs = []
+        for run in runs:
+            df = pd.DataFrame({name: h5f[run][name][:] for name in palm_result_columns})
+            if df.empty:
+                # avoid casting columns of other runs to the data type of empty arrays
+                continue
+            df.insert(0, "run", run)
+            dfs.append(df)
+
+    if not dfs:
+        return pd.DataFrame(columns=["run", *palm_result_columns])
+
+    return pd.concat(dfs, ignore_index=True)
 
 
 def richardson_lucy_deconv(streaked_signal, reference_signal, iterations=200, noise=0.3):
@@ -1,17 +1,21 @@
-import warnings
-from functools import partial
-from multiprocessing import Pool
-
-import h5py
 import numpy as np
 
-from .utils import find_edge, read_eco_scan
+from .bsread_reader import RDCC_NBYTES, BsreadReader, project_images, split_rows
+from .encoder_mixin import EncoderMixin
+from .executor import map_method
+from .utils import (
+    find_edge,
+    process_chunks,
+    read_eco_scan,
+    subpixel_methods,
+    xcorr_methods,
+)
 
 background_methods = ["div", "sub"]
 edge_types = ["falling", "rising"]
 
 
-class SpatialEncoder:
+class SpatialEncoder(EncoderMixin):
     def __init__(
         self,
         channel,
@@ -23,6 +27,11 @@ class SpatialEncoder:
         dark_shot_filter=None,
         refinement=1,
         edge_type="falling",
+        xcorr_method="direct",
+        subpixel=None,
+        search_window=None,
+        cache=None,
+        executor=None,
     ):
         """Initialize SpatialEncoder object.
 
@@ -38,6 +47,16 @@ class SpatialEncoder:
             dark_shot_filter: a function to return True for dark shots based on pulse_id argument
             refinement: quantisation size for linear interpolation of data and a step waveform
             edge_type: {'falling', 'rising'} a type of edge to search for
+            xcorr_method: {'direct', 'fft', 'cumsum'} cross-correlation method, 'fft' and
+                'cumsum' process all waveforms in a single vectorized pass ('cumsum' is only
+                available for refinement == 1)
+            subpixel: {None, 'parabolic', 'gaussian', 'centroid'} method to estimate edge
+                positions with sub-pixel precision from neighbouring cross-correlation values
+            search_window: if not None, find coarse edges on unrefined data first, and refine
+                them only within +/- search_window pix (full cross-correlation results are then
+                returned only if `debug` is True)
+            cache: (optional) ResultCache to store results of processed hdf5 files
+            executor: (optional) Executor with workers to be used in `process_eco`
         """
         if events_channel and dark_shot_filter:
             raise Exception("Either 'events_channel' and/or 'dark_shot_filter' should be None")
@@ -53,6 +72,11 @@ class SpatialEncoder:
         self._background = None
         self.pix_per_fs = None
         self.edge_type = edge_type
+        self.xcorr_method = xcorr_method
+        self.subpixel = subpixel
+        self.search_window = search_window
+        self.cache = cache
+        self.executor = executor
 
     @property
     def background_method(self):
@@ -74,6 +98,26 @@ class SpatialEncoder:
             raise ValueError(f"Unknown edge type '{value}'")
         self.__edge_type = value
 
+    @property
+    def xcorr_method(self):
+        return self.__xcorr_method
+
+    @xcorr_method.setter
+    def xcorr_method(self, value):
+        if value not in xcorr_methods:
+            raise ValueError(f"Unknown cross-correlation method '{value}'")
+        self.__xcorr_method = value
+
+    @property
+    def subpixel(self):
+        return self.__subpixel
+
+    @subpixel.setter
+    def subpixel(self, value):
+        if value not in subpixel_methods:
+            raise ValueError(f"Unknown sub-pixel method '{value}'")
+        self.__subpixel = value
+
     @property
     def step_length(self):
         return self.__step_length
@@ -99,7 +143,7 @@ class SpatialEncoder:
 
         self._background = data.mean(axis=0)
 
-    def calibrate_time(self, filepath, method="avg_edge", nproc=1):
+    def calibrate_time(self, filepath, method="avg_edge", nproc=1, backend="process"):
         """Calibrate pixel to time conversion.
 
         Args:
@@ -107,7 +151,8 @@ class SpatialEncoder:
             method: {avg_wf, avg_edge}
                 'avg_wf': single edge position of averaged raw waveform (per scan step)
                 'avg_edge': mean of edge positions for all raw waveforms (per scan step)
-            nproc: number of worker processes to use
+            nproc: number of workers to use (ignored if executor is present)
+            backend: {'process', 'thread'} type of workers (ignored if executor is present)
         """
         if (
             self.events_channel is None
@@ -121,20 +166,26 @@ class SpatialEncoder:
 
             edge_pos_pix = np.empty(len(scan_pos_fs))
             for i, bsread_file in enumerate(bsread_files):
-                data, _, _, _ = self._read_bsread_file(bsread_file)
+                with BsreadReader(bsread_file) as reader:
+                    data, _, _, _ = self._read_bsread_file(reader)
                 data = data.mean(axis=0)
 
                 results = self.process(data)
                 edge_pos_pix[i] = results["edge_pos"]
 
         elif method == "avg_edge":
-            results = self.process_eco(filepath, nproc=nproc)
-
-            scan_pos_fs = np.empty(len(results))
-            edge_pos_pix = np.empty(len(results))
-            for i, data in enumerate(results):
-                scan_pos_fs[i] = data["scan_pos_fs"]
-                edge_pos_pix[i] = np.nanmean(data["edge_pos"])
+            steps = []
+            scan_pos_fs = []
+            edge_pos_pix = []
+            # only averaged edge positions of scan steps are kept in memory
+            for data in self.iter_eco(filepath, nproc=nproc, backend=backend):
+                steps.append(data["step"])
+                scan_pos_fs.append(data["scan_pos_fs"])
+                edge_pos_pix.append(np.nanmean(data["edge_pos"]))
+
+            order = np.argsort(steps)
+            scan_pos_fs = np.array(scan_pos_fs)[order]
+            edge_pos_pix = np.array(edge_pos_pix)[order]
 
         # pixel -> fs conversion coefficient
         fit_coeff = np.polyfit(scan_pos_fs, edge_pos_pix, 1)
@@ -171,32 +222,102 @@ class SpatialEncoder:
             data /= self._background
             data = np.log10(data)
 
-        output = find_edge(data, self.step_length, self.edge_type, self.refinement)
+        output = find_edge(
+            data,
+            self.step_length,
+            self.edge_type,
+            self.refinement,
+            method=self.xcorr_method,
+            subpixel=self.subpixel,
+            search_window=self.search_window,
+            return_xcorr=debug or self.search_window is None,
+        )
 
         if debug:
             output["raw_input"] = data
 
         return output
 
-    def process_hdf5(self, filepath, debug=False):
+    def process_hdf5(
+        self,
+        filepath,
+        debug=False,
+        chunk_size=None,
+        memmap=False,
+        rdcc_nbytes=RDCC_NBYTES,
+        nproc=1,
+        backend="process",
+    ):
         """Process spatial encoder data from hdf5 file.
 
         Args:
             filepath: hdf5 file to be processed
             debug: return debug data
+            chunk_size: if not None, read and process data in chunks of `chunk_size` shots with
+                bounded memory (original camera images are not returned in this mode)
+            memmap: memory-map contiguous uncompressed datasets instead of reading them
+            rdcc_nbytes: size of the hdf5 raw data chunk cache per dataset in bytes
+            nproc: if > 1, split shots of the file in contiguous ranges between `nproc` workers
+                (executor workers are used if executor is present, original camera
+                images are not returned in this mode)
+            backend: {'process', 'thread'} type of workers (ignored if executor is present)
         Returns:
             edge position(s) in pix and corresponding pulse ids
             cross-correlation results and raw data if `debug` is True
+            (results are taken from/put to the cache if it is present and `debug` is False,
+            cross-correlation results are not cached)
         """
-        data, pulse_id, is_dark, images = self._read_bsread_file(filepath, return_images=debug)
+        if self.cache is not None and not debug:
+            cache_key = self.cache.key(filepath, self._cache_params())
+            output = self.cache.get(cache_key)
+            if output is not None:
+                background = output.pop("background")
+                if self.events_channel or self.dark_shot_filter:
+                    # keep the side effect of background calibration
+                    self._background = background
+                return output
+
+        with BsreadReader(filepath, memmap=memmap, rdcc_nbytes=rdcc_nbytes) as reader:
+            if nproc > 1:
+                output, pulse_id, is_dark = self._process_shot_ranges(
+                    reader, nproc, backend, debug, chunk_size, memmap, rdcc_nbytes
+                )
+                images = None
 
-        if self.events_channel or self.dark_shot_filter:
-            self.calibrate_background(data, is_dark)
-        else:
-            if self._background is None:
-                raise Exception("Background calibration is not found")
+            elif chunk_size is None:
+                data, pulse_id, is_dark, images = self._read_bsread_file(
+                    reader, return_images=debug
+                )
+
+                if self.events_channel or self.dark_shot_filter:
+                    self.calibrate_background(data, is_dark)
+                else:
+                    if self._background is None:
+                        raise Exception("Background calibration is not found")
 
-        output = self.process(data, debug=debug)
+                output = self.process(data, debug=debug)
+
+            else:
+                if self.events_channel or self.dark_shot_filter:
+                    # background calibration requires a separate pass over the file
+                    data_sum = 0
+                    n_dark = 0
+                    for _, is_dark, data in self._iter_chunks(reader, chunk_size):
+                        data_sum += data[is_dark].sum(axis=0)
+                        n_dark += np.count_nonzero(is_dark)
+
+                    if n_dark == 0:
+                        raise Exception("None of pulse ids correspond to dark shots")
+
+                    self._background = data_sum / n_dark
+                else:
+                    if self._background is None:
+                        raise Exception("Background calibration is not found")
+
+                output, pulse_id, is_dark = process_chunks(
+                    self.process, self._iter_chunks(reader, chunk_size), debug=debug
+                )
+                images = None
 
         if is_dark is not None:
             output["edge_pos"][is_dark] = np.nan
@@ -205,15 +326,30 @@ class SpatialEncoder:
         output["is_dark"] = is_dark
         output["images"] = images
 
+        if self.cache is not None and not debug:
+            output.pop("xcorr", None)
+            self.cache.put(cache_key, {**output, "background": self._background})
+
         return output
 
-    def process_eco(self, filepath, nproc=1, debug=False):
+    def process_eco(
+        self,
+        filepath,
+        nproc=1,
+        debug=False,
+        memmap=False,
+        rdcc_nbytes=RDCC_NBYTES,
+        backend="process",
+    ):
         """Process spatial encoder data from eco scan file.
 
         Args:
             filepath: json eco scan file to be processed
-            nproc: number of worker processes to use
+            nproc: number of workers to use (ignored if executor is present)
             debug: return debug data
+            memmap: memory-map contiguous uncompressed datasets instead of reading them
+            rdcc_nbytes: size of the hdf5 raw data chunk cache per dataset in bytes
+            backend: {'process', 'thread'} type of workers (ignored if executor is present)
         Returns:
             edge position(s) in pix, corresponding pulse ids and scan readback values
             cross-correlation results and raw data if `debug` is True
@@ -226,74 +362,110 @@ class SpatialEncoder:
 
         scan_pos_fs, bsread_files = read_eco_scan(filepath)
 
-        with Pool(processes=nproc) as pool:
-            output = pool.map(partial(self.process_hdf5, debug=debug), bsread_files)
+        output = map_method(
+            self,
+            "process_hdf5",
+            bsread_files,
+            nproc,
+            backend,
+            debug=debug,
+            memmap=memmap,
+            rdcc_nbytes=rdcc_nbytes,
+        )
 
         for i, step_output in enumerate(output):
             step_output["scan_pos_fs"] = scan_pos_fs[i]
 
         return output
 
-    def _read_bsread_file(self, filepath, return_images=False):
-        """Read spatial encoder data from bsread hdf5 file.
-
-        Args:
-            filepath: path to a bsread hdf5 file to read data from
-            return_images: whether to return original camera images
-        Returns:
-            data, pulse_id, is_dark
+    def _cache_params(self):
+        """Return all parameters that affect results of `process_hdf5`.
         """
-        with h5py.File(filepath, "r") as h5f:
-            if "/data" in h5f:
-                # sf_databuffer_writer format
-                path_prefix = "/data/{}"
-            else:
-                # bsread format
-                path_prefix = "/{}"
+        params = super()._cache_params()
 
-            channel_group = h5f[path_prefix.format(self.channel)]
-            pulse_id = channel_group["pulse_id"][:]
+        if self.events_channel or self.dark_shot_filter:
+            # background is calibrated on the processed file
+            del params["_background"]
 
-            if self.events_channel:
-                events_channel_group = h5f[path_prefix.format(self.events_channel)]
-                events_pulse_id = events_channel_group["pulse_id"][:]
+        return params
 
-                pid, index, event_index = np.intersect1d(
-                    pulse_id, events_pulse_id, return_indices=True
-                )
+    def _select_pulses(self, reader):
+        return reader.select_pulses(
+            self.channel, self.events_channel, self.dark_shot_event, self.dark_shot_filter
+        )
 
-                # if both groups have 0 in their pulse_id
-                pid_zero_ind = pid == 0
-                if any(pid_zero_ind):
-                    warnings.warn(
-                        f"\n \
-                    File: {filepath}\n \
-                    Both '{self.channel}' and '{self.events_channel}' have zeroed pulse_id(s).\n"
-                    )
-                    index = index[~pid_zero_ind]
-                    event_index = event_index[~pid_zero_ind]
-
-                is_dark = events_channel_group["data"][event_index, self.dark_shot_event].astype(
-                    bool
-                )
+    def _signal_dataset(self, reader):
+        return reader.dataset(self.channel)
 
-            elif self.dark_shot_filter:
-                index = pulse_id != 0
-                is_dark = self.dark_shot_filter(pulse_id)[index]
+    def _iter_rows(self, reader, index, chunk_size):
+        return reader.iter_rows(self.channel, index, self.roi, chunk_size=chunk_size)
 
-            else:
-                index = pulse_id != 0
-                is_dark = None
+    def _read_bsread_file(self, reader, return_images=False):
+        """Read spatial encoder data from bsread hdf5 file.
 
-            pulse_id = pulse_id[index]
+        Args:
+            reader: BsreadReader of a bsread hdf5 file to read data from
+            return_images: whether to return original camera images
+        Returns:
+            data, pulse_id, is_dark, images
+        """
+        pulse_id, index, is_dark = self._select_pulses(reader)
 
-            # data is stored as uint16 in hdf5, so has to be casted to float for further analysis,
-            images = channel_group["data"][index, slice(*self.roi), :].astype(float)
+        images = reader.read_images(self.channel, index, roi=self.roi)
 
-            # averaging every image over y-axis gives the final raw waveforms
-            data = images.mean(axis=1)
+        # averaging every image over y-axis gives the final raw waveforms
+        data = project_images(images)
 
         if return_images:
-            return data, pulse_id, is_dark, images
+            # data is stored as uint16 in hdf5, so has to be casted to float for further analysis
+            return data, pulse_id, is_dark, images.astype(float)
 
         return data, pulse_id, is_dark, None
+
+    def _iter_chunks(self, reader, chunk_size):
+        """Read spatial encoder data from bsread hdf5 file in chunks.
+
+        Args:
+            reader: BsreadReader of a bsread hdf5 file to read data from
+            chunk_size: number of shots per chunk
+        Yields:
+            pulse_id, is_dark, data of every chunk
+        """
+        return reader.iter_chunks(
+            self.channel,
+            self.events_channel,
+            self.dark_shot_event,
+            self.dark_shot_filter,
+            roi=self.roi,
+            chunk_size=chunk_size,
+        )
+
+    def _calibrate_shot_ranges(self, index, is_dark, chunks, nproc, backend, worker_kwargs):
+        if not (self.events_channel or self.dark_shot_filter):
+            super()._calibrate_shot_ranges(index, is_dark, chunks, nproc, backend, worker_kwargs)
+            return
+
+        if not np.any(is_dark):
+            raise Exception("None of pulse ids correspond to dark shots")
+
+        # only dark shots are read for background calibration
+        dark_index = index[is_dark]
+        outputs = map_method(
+            self,
+            "_sum_shots",
+            split_rows(dark_index, nproc, chunks),
+            nproc,
+            backend,
+            **worker_kwargs,
+        )
+        self._background = sum(output["data_sum"] for output in outputs) / dark_index.size
+
+    def _sum_shots(self, index, filepath, chunk_size, memmap, rdcc_nbytes):
+        """Sum spatial encoder data of selected shots (runs in a worker).
+        """
+        data_sum = 0
+        with BsreadReader(filepath, memmap=memmap, rdcc_nbytes=rdcc_nbytes) as reader:
+            for _, data in self._iter_rows(reader, index, chunk_size):
+                data_sum += data.sum(axis=0)
+
+        return {"data_sum": data_sum}
@@ -15,15 +15,16 @@ hold_image_ref = []
 
 
 class SpatialEncoderViewer(SpatialEncoder):
-    def plot_hdf5(self, filepath, image_downscale=1):
+    def plot_hdf5(self, filepath, image_downscale=1, memmap=False):
         """Experimental viewer for hdf5 files in a jupyter notebook.
 
         Args:
             filepath: hdf5 file to be processed
             image_downscale: an image resampling factor
+            memmap: memory-map contiguous uncompressed datasets instead of reading them
         """
         global hold_image_ref
-        results = self.process_hdf5(filepath, debug=True)
+        results = self.process_hdf5(filepath, debug=True, memmap=memmap)
 
         images = results["images"]
         edge_pos = results["edge_pos"]
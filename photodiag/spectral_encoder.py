@@ -1,16 +1,20 @@
-import warnings
-from functools import partial
-from multiprocessing import Pool
-
-import h5py
 import numpy as np
 
-from .utils import find_edge, read_eco_scan
+from .bsread_reader import RDCC_NBYTES, BsreadReader
+from .encoder_mixin import EncoderMixin
+from .executor import map_method
+from .utils import (
+    find_edge,
+    process_chunks,
+    read_eco_scan,
+    subpixel_methods,
+    xcorr_methods,
+)
 
 edge_types = ["falling", "rising"]
 
 
-class SpectralEncoder:
+class SpectralEncoder(EncoderMixin):
     def __init__(
         self,
         signal_channel,
@@ -23,6 +27,13 @@ class SpectralEncoder:
         early_shot_filter=None,
         refinement=1,
         edge_type="falling",
+        xcorr_method="direct",
+        subpixel=None,
+        search_window=None,
+        roi=(None, None),
+        roi_x=(None, None),
+        cache=None,
+        executor=None,
     ):
         """Initialize SpectralEncoder object.
 
@@ -37,6 +48,19 @@ class SpectralEncoder:
             early_shot_filter: a function to return True for early shots based on pulse_id argument
             refinement: quantisation size for linear interpolation of data and a step waveform
             edge_type: {'falling', 'rising'} a type of edge to search for
+            xcorr_method: {'direct', 'fft', 'cumsum'} cross-correlation method, 'fft' and
+                'cumsum' process all waveforms in a single vectorized pass ('cumsum' is only
+                available for refinement == 1)
+            subpixel: {None, 'parabolic', 'gaussian', 'centroid'} method to estimate edge
+                positions with sub-pixel precision from neighbouring cross-correlation values
+            search_window: if not None, find coarse edges on unrefined data first, and refine
+                them only within +/- search_window pix (full cross-correlation results are then
+                returned only if `debug` is True)
+            roi: region of interest for image projection along y-axis
+            roi_x: region of interest along x-axis, edge positions are relative to its start
+                (background should be of the same length)
+            cache: (optional) ResultCache to store results of processed hdf5 files
+            executor: (optional) Executor with workers to be used in `process_eco`
         """
         if events_channel and dark_shot_filter:
             raise Exception("Either 'events_channel' and/or 'dark_shot_filter' should be None")
@@ -53,6 +77,13 @@ class SpectralEncoder:
         self._background = None
         self.pix_per_fs = None
         self.edge_type = edge_type
+        self.xcorr_method = xcorr_method
+        self.subpixel = subpixel
+        self.search_window = search_window
+        self.roi = roi
+        self.roi_x = roi_x
+        self.cache = cache
+        self.executor = executor
 
     @property
     def edge_type(self):
@@ -64,6 +95,26 @@ class SpectralEncoder:
             raise ValueError(f"Unknown edge type '{value}'")
         self.__edge_type = value
 
+    @property
+    def xcorr_method(self):
+        return self.__xcorr_method
+
+    @xcorr_method.setter
+    def xcorr_method(self, value):
+        if value not in xcorr_methods:
+            raise ValueError(f"Unknown cross-correlation method '{value}'")
+        self.__xcorr_method = value
+
+    @property
+    def subpixel(self):
+        return self.__subpixel
+
+    @subpixel.setter
+    def subpixel(self, value):
+        if value not in subpixel_methods:
+            raise ValueError(f"Unknown sub-pixel method '{value}'")
+        self.__subpixel = value
+
     @property
     def step_length(self):
         return self.__step_length
@@ -74,7 +125,7 @@ class SpectralEncoder:
             raise ValueError(f"A reasonable step length should be >= 4")
         self.__step_length = value
 
-    def calibrate_time(self, filepath, method="avg_edge", nproc=1):
+    def calibrate_time(self, filepath, method="avg_edge", nproc=1, backend="process"):
         """Calibrate pixel to time conversion.
 
         Args:
@@ -82,7 +133,8 @@ class SpectralEncoder:
             method: {avg_wf, avg_edge}
                 'avg_wf': single edge position of averaged raw waveform (per scan step)
                 'avg_edge': mean of edge positions for all raw waveforms (per scan step)
-            nproc: number of worker processes to use
+            nproc: number of workers to use (ignored if executor is present)
+            backend: {'process', 'thread'} type of workers (ignored if executor is present)
         """
         if (
             self.events_channel is None
@@ -96,20 +148,26 @@ class SpectralEncoder:
 
             edge_pos_pix = np.empty(len(scan_pos_fs))
             for i, bsread_file in enumerate(bsread_files):
-                data, _, _ = self._read_bsread_file(bsread_file)
+                with BsreadReader(bsread_file) as reader:
+                    data, _, _ = self._read_bsread_file(reader)
                 data = data.mean(axis=0)
 
                 results = self.process(data)
                 edge_pos_pix[i] = results["edge_pos"]
 
         elif method == "avg_edge":
-            results = self.process_eco(filepath, nproc=nproc)
-
-            scan_pos_fs = np.empty(len(results))
-            edge_pos_pix = np.empty(len(results))
-            for i, data in enumerate(results):
-                scan_pos_fs[i] = data["scan_pos_fs"]
-                edge_pos_pix[i] = np.nanmean(data["edge_pos"])
+            steps = []
+            scan_pos_fs = []
+            edge_pos_pix = []
+            # only averaged edge positions of scan steps are kept in memory
+            for data in self.iter_eco(filepath, nproc=nproc, backend=backend):
+                steps.append(data["step"])
+                scan_pos_fs.append(data["scan_pos_fs"])
+                edge_pos_pix.append(np.nanmean(data["edge_pos"]))
+
+            order = np.argsort(steps)
+            scan_pos_fs = np.array(scan_pos_fs)[order]
+            edge_pos_pix = np.array(edge_pos_pix)[order]
 
         # pixel -> fs conversion coefficient
         fit_coeff = np.polyfit(scan_pos_fs, edge_pos_pix, 1)
@@ -143,26 +201,77 @@ class SpectralEncoder:
         data /= self._background
         np.log10(data, out=data)
 
-        output = find_edge(data, self.step_length, self.edge_type, self.refinement)
+        output = find_edge(
+            data,
+            self.step_length,
+            self.edge_type,
+            self.refinement,
+            method=self.xcorr_method,
+            subpixel=self.subpixel,
+            search_window=self.search_window,
+            return_xcorr=debug or self.search_window is None,
+        )
 
         if debug:
             output["raw_input"] = data
 
         return output
 
-    def process_hdf5(self, filepath, debug=False):
+    def process_hdf5(
+        self,
+        filepath,
+        debug=False,
+        chunk_size=None,
+        memmap=False,
+        rdcc_nbytes=RDCC_NBYTES,
+        nproc=1,
+        backend="process",
+    ):
         """Process spectral encoder data from hdf5 file.
 
         Args:
             filepath: hdf5 file to be processed
             debug: return debug data
+            chunk_size: if not None, read and process data in chunks of `chunk_size` shots with
+                bounded memory
+            memmap: memory-map contiguous uncompressed datasets instead of reading them
+            rdcc_nbytes: size of the hdf5 raw data chunk cache per dataset in bytes
+            nproc: if > 1, split shots of the file in contiguous ranges between `nproc` workers
+                (executor workers are used if executor is present)
+            backend: {'process', 'thread'} type of workers (ignored if executor is present)
         Returns:
             edge position(s) in pix and corresponding pulse ids
             cross-correlation results and raw data if `debug` is True
+            (results are taken from/put to the cache if it is present and `debug` is False,
+            cross-correlation results are not cached)
         """
-        data, pulse_id, is_dark = self._read_bsread_file(filepath)
+        if self.cache is not None and not debug:
+            cache_key = self.cache.key(filepath, self._cache_params())
+            output = self.cache.get(cache_key)
+            if output is not None:
+                return output
+
+        with BsreadReader(filepath, memmap=memmap, rdcc_nbytes=rdcc_nbytes) as reader:
+            if nproc > 1:
+                output, pulse_id, is_dark = self._process_shot_ranges(
+                    reader, nproc, backend, debug, chunk_size, memmap, rdcc_nbytes
+                )
+
+            elif chunk_size is None:
+                data, pulse_id, is_dark = self._read_bsread_file(reader)
+                output = self.process(data, debug=debug)
 
-        output = self.process(data, debug=debug)
+            else:
+                chunks = reader.iter_chunks(
+                    self.signal_channel,
+                    self.events_channel,
+                    self.dark_shot_event,
+                    self.dark_shot_filter,
+                    self.roi,
+                    self.roi_x,
+                    chunk_size,
+                )
+                output, pulse_id, is_dark = process_chunks(self.process, chunks, debug=debug)
 
         if is_dark is not None:
             output["edge_pos"][is_dark] = np.nan
@@ -170,15 +279,30 @@ class SpectralEncoder:
         output["pulse_id"] = pulse_id
         output["is_dark"] = is_dark
 
+        if self.cache is not None and not debug:
+            output.pop("xcorr", None)
+            self.cache.put(cache_key, output)
+
         return output
 
-    def process_eco(self, filepath, nproc=1, debug=False):
+    def process_eco(
+        self,
+        filepath,
+        nproc=1,
+        debug=False,
+        memmap=False,
+        rdcc_nbytes=RDCC_NBYTES,
+        backend="process",
+    ):
         """Process spectral encoder data from eco scan file.
 
         Args:
             filepath: json eco scan file to be processed
-            nproc: number of worker processes to use
+            nproc: number of workers to use (ignored if executor is present)
             debug: return debug data
+            memmap: memory-map contiguous uncompressed datasets instead of reading them
+            rdcc_nbytes: size of the hdf5 raw data chunk cache per dataset in bytes
+            backend: {'process', 'thread'} type of workers (ignored if executor is present)
         Returns:
             edge position(s) in pix, corresponding pulse ids and scan readback values
             cross-correlation results and raw data if `debug` is True
@@ -191,72 +315,37 @@ class SpectralEncoder:
 
         scan_pos_fs, bsread_files = read_eco_scan(filepath)
 
-        with Pool(processes=nproc) as pool:
-            output = pool.map(partial(self.process_hdf5, debug=debug), bsread_files)
+        output = map_method(
+            self,
+            "process_hdf5",
+            bsread_files,
+            nproc,
+            backend,
+            debug=debug,
+            memmap=memmap,
+            rdcc_nbytes=rdcc_nbytes,
+        )
 
         for i, step_output in enumerate(output):
             step_output["scan_pos_fs"] = scan_pos_fs[i]
 
         return output
 
-    def _read_bsread_file(self, filepath):
+    def _read_bsread_file(self, reader):
         """Read spectral encoder data from bsread hdf5 file.
 
         Args:
-            filepath: path to a bsread hdf5 file to read data from
+            reader: BsreadReader of a bsread hdf5 file to read data from
         Returns:
             data, pulse_id, is_dark
         """
-        with h5py.File(filepath, "r") as h5f:
-            if "/data" in h5f:
-                # sf_databuffer_writer format
-                path_prefix = "/data/{}"
-            else:
-                # bsread format
-                path_prefix = "/{}"
-
-            signal_channel_group = h5f[path_prefix.format(self.signal_channel)]
-            signal_pulse_id = signal_channel_group["pulse_id"][:]
-
-            if self.events_channel:
-                events_channel_group = h5f[path_prefix.format(self.events_channel)]
-                events_pulse_id = events_channel_group["pulse_id"][:]
-
-                pid, index, event_index = np.intersect1d(
-                    signal_pulse_id, events_pulse_id, return_indices=True
-                )
-
-                # if both groups have 0 in their pulse_id
-                pid_zero_ind = pid == 0
-                if any(pid_zero_ind):
-                    warnings.warn(
-                        f"\n \
-                    File: {filepath}\n \
-                    Both '{self.signal_channel}' and '{self.events_channel}' have zeroed pulse_id(s).\n"
-                    )
-                    index = index[~pid_zero_ind]
-                    event_index = event_index[~pid_zero_ind]
-
-                is_dark = events_channel_group["data"][event_index, self.dark_shot_event].astype(
-                    bool
-                )
-
-            elif self.dark_shot_filter:
-                index = signal_pulse_id != 0
-                is_dark = self.dark_shot_filter(signal_pulse_id)[index]
-
-            else:
-                index = signal_pulse_id != 0
-                is_dark = None
-
-            signal_pulse_id = signal_pulse_id[index]
-
-            # data is stored as uint16 in hdf5, so has to be casted to float for further analysis,
-            images = signal_channel_group["data"][index].astype(float)
-
-            # averaging every image over y-axis gives the final raw waveforms
-            data = images.mean(axis=1)
-
-        return data, signal_pulse_id, is_dark
+        return reader.read(
+            self.signal_channel,
+            self.events_channel,
+            self.dark_shot_event,
+            self.dark_shot_filter,
+            self.roi,
+            self.roi_x,
+        )
 
 # implement fringe filtering in the Fourier domain
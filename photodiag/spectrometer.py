@@ -1,7 +1,13 @@
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from scipy.optimize import curve_fit
 
+from photodiag.utils import interp_operator
+
+# convert: number of waveforms to be interpolated at once
+CONVERT_BLOCK_ROWS = 1000
+
 
 class Spectrometer:
     """Class describing a single eTOF spectrometer.
@@ -122,18 +128,23 @@ class Spectrometer:
         flight_time = np.arange(1, self.internal_time_bins - self.calib_t0)
         pulse_energy = (self.calib_a / flight_time) ** 2 + self.calib_b
 
-        output_data = input_data[:, self.calib_t0 + 1 :]
+        # a sparse operator performs the same 1D interpolation for all waveforms at once
+        # (pulse energies are decreasing, so the operator is built for reversed waveforms)
+        operator = interp_operator(np.asarray(interp_energy), pulse_energy[::-1])[:, ::-1]
 
         if jacobian:
             jacobian_factor_inv = -pulse_energy ** (3 / 2)  # = 1 / jacobian_factor
-            output_data /= jacobian_factor_inv  # = spectr.data * jacobian_factor
+            operator = operator @ sparse.diags(1 / jacobian_factor_inv)  # = data * jacobian_factor
 
-        def interpolate_row(data, energy, interp_energy):
-            return np.interp(interp_energy, energy, data)
+        operator = operator.tocsr()
 
-        output_data = np.apply_along_axis(
-            interpolate_row, 1, output_data[:, ::-1], pulse_energy[::-1], interp_energy
-        )
+        input_data = input_data[:, self.calib_t0 + 1 :]
+        output_data = np.empty((input_data.shape[0], operator.shape[0]))
+
+        # process waveforms in blocks to limit the size of temporary arrays
+        for start in range(0, input_data.shape[0], CONVERT_BLOCK_ROWS):
+            block = slice(start, start + CONVERT_BLOCK_ROWS)
+            output_data[block] = (operator @ input_data[block].T).T
 
         output_data -= noise_thr * self.calib_data["noise_std"].mean()
 
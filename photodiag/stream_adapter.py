@@ -3,7 +3,7 @@ from collections import deque
 
 import numpy as np
 
-from .utils import find_edge_1d, savgol_filter_1d
+from .utils import SavgolFilter, find_edge_1d, xcorr_methods
 
 edge_types = ["falling", "rising"]
 
@@ -21,7 +21,16 @@ savgol_steps = 2038
 
 
 class StreamAdapter:
-    def __init__(self, json_config, step_length=50, refinement=1, edge_type="falling"):
+    def __init__(
+        self,
+        json_config,
+        step_length=50,
+        refinement=1,
+        edge_type="falling",
+        xcorr_method="direct",
+        track_window=None,
+        track_threshold=0.5,
+    ):
         """Initialize StreamAdapter object.
 
         Args:
@@ -29,6 +38,12 @@ class StreamAdapter:
             dark_shot_filter: a function to return True for dark shots based on pulse_id argument
             refinement: quantisation size for linear interpolation of data and a step waveform
             edge_type: {'falling', 'rising'} a type of edge to search for
+            xcorr_method: {'direct', 'fft', 'cumsum'} cross-correlation method
+            track_window: if not None, search for an edge only within +/- track_window pix around
+                a running estimate of the last edge positions
+            track_threshold: fall back to a full search if the absolute cross-correlation amplitude
+                in a tracking window drops below this fraction of the absolute amplitude of the
+                last full search
         """
         with open(json_config) as f:
             self.config = json.load(f)
@@ -38,6 +53,14 @@ class StreamAdapter:
         self._background = None
         self.pix_per_fs = None
         self.edge_type = edge_type
+        self.xcorr_method = xcorr_method
+        self._savgol_filter = SavgolFilter(savgol_period, savgol_window, savgol_steps)
+        self.track_window = track_window
+        self.track_threshold = track_threshold
+        self._edge_tracks = {
+            "bkg": {"edge_pos": deque(maxlen=5), "xcorr_ampl": None},
+            "ref": {"edge_pos": deque(maxlen=5), "xcorr_ampl": None},
+        }
 
     @property
     def edge_type(self):
@@ -49,6 +72,16 @@ class StreamAdapter:
             raise ValueError(f"Unknown edge type '{value}'")
         self.__edge_type = value
 
+    @property
+    def xcorr_method(self):
+        return self.__xcorr_method
+
+    @xcorr_method.setter
+    def xcorr_method(self, value):
+        if value not in xcorr_methods:
+            raise ValueError(f"Unknown cross-correlation method '{value}'")
+        self.__xcorr_method = value
+
     @property
     def step_length(self):
         return self.__step_length
@@ -82,8 +115,8 @@ class StreamAdapter:
             I0_deque.append(message.data.data[self.config["I0"]].value)
 
         if preproc_filter:
-            signal = savgol_filter_1d(signal, savgol_period, savgol_window, savgol_steps)
-            ref = savgol_filter_1d(ref, savgol_period, savgol_window, savgol_steps)
+            signal = self._savgol_filter(signal)
+            ref = self._savgol_filter(ref)
 
         if is_delayed:  # update background (signal roi is a background)
             # TODO: can the ref be used as a background too?
@@ -92,8 +125,8 @@ class StreamAdapter:
         else:  # extract edge
             if bkg_deque:  # remove background
                 signal_wo_bkg = signal / (sum(bkg_deque) / len(bkg_deque))
-                res = find_edge_1d(signal_wo_bkg, self.step_length, self.edge_type)
-                Xcor_deque.append(np.max(res["xcorr"][0]))
+                res = self._find_edge(signal_wo_bkg, self._edge_tracks["bkg"])
+                Xcor_deque.append(res["xcorr_ampl"])
 
         ref_deque.append(ref)
         avg_ref = sum(ref_deque) / len(ref_deque)
@@ -107,5 +140,39 @@ class StreamAdapter:
                 avg_ref /= (sum(ref_correction_deque) / len(ref_correction_deque))
 
             signal_wo_ref = signal / avg_ref
-            res_ref = find_edge_1d(signal_wo_ref, self.step_length, self.edge_type)
-            Xcor_deque_ref.append(np.max(res_ref["xcorr"][0]))
+            res_ref = self._find_edge(signal_wo_ref, self._edge_tracks["ref"])
+            Xcor_deque_ref.append(res_ref["xcorr_ampl"])
+
+    def _find_edge(self, data, edge_track):
+        """Find an edge in a tracking window, or in the full waveform if tracking is not possible.
+
+        Args:
+            data: waveform to be processed
+            edge_track: dictionary with last edge positions and a reference xcorr amplitude
+        Returns:
+            results of `find_edge_1d` with edge position in the full waveform coordinates (the
+            cross-correlation peak amplitude is the same as for a full search, while 'xcorr' only
+            covers the tracking window if tracking succeeded)
+        """
+        if self.track_window is not None and edge_track["edge_pos"]:
+            half_step = int(self.step_length / 2)
+            center = int(np.median(edge_track["edge_pos"]))
+            start = max(center - half_step - self.track_window, 0)
+            stop = min(center - half_step + self.track_window + self.step_length, data.size)
+
+            if stop - start >= self.step_length:
+                res = find_edge_1d(
+                    data[start:stop], self.step_length, self.edge_type, self.xcorr_method
+                )
+
+                ampl_thr = self.track_threshold * abs(edge_track["xcorr_ampl"])
+                if abs(res["xcorr_ampl"]) >= ampl_thr:
+                    res["edge_pos"] += start
+                    edge_track["edge_pos"].append(res["edge_pos"])
+                    return res
+
+        res = find_edge_1d(data, self.step_length, self.edge_type, self.xcorr_method)
+        edge_track["edge_pos"].append(res["edge_pos"])
+        edge_track["xcorr_ampl"] = res["xcorr_ampl"]
+
+        return res
@@ -1,9 +1,22 @@
 import json
-import warnings
+import os
+import tempfile
+import time
+from functools import lru_cache, partial
 
-import h5py
 import numpy as np
-from scipy import signal
+from scipy import signal, sparse
+from scipy.fft import irfft, next_fast_len, rfft
+
+from .bsread_reader import RDCC_NBYTES, BsreadReader
+
+xcorr_methods = ["direct", "fft", "cumsum"]
+subpixel_methods = [None, "parabolic", "gaussian", "centroid"]
+
+# map_via_scratch: minimal size of arrays to be passed from worker processes via scratch files
+SCRATCH_MIN_NBYTES = 2 ** 16
+# map_via_scratch: location of scratch files, memory-backed /dev/shm is used if available
+SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
 
 
 def read_eco_scan(filepath):
@@ -28,16 +41,19 @@ def read_eco_scan(filepath):
     return scan_pos_fs, bsread_files
 
 
-def find_edge_1d(data, step_length=50, edge_type="falling"):
-    # prepare a step function
-    step_waveform = np.ones(shape=(step_length,))
-    if edge_type == "rising":
-        step_waveform[: int(step_length / 2)] = -1
-    elif edge_type == "falling":
-        step_waveform[int(step_length / 2) :] = -1
+def find_edge_1d(data, step_length=50, edge_type="falling", method="direct"):
+    if method not in xcorr_methods:
+        raise ValueError(f"Unknown cross-correlation method '{method}'")
 
     # find edges
-    xcorr = np.correlate(data, v=step_waveform, mode="valid")
+    if method == "direct":
+        step_waveform = _step_waveform(step_length, edge_type)
+        xcorr = np.correlate(data, v=step_waveform, mode="valid")
+    elif method == "fft":
+        xcorr = _xcorr_fft(data[np.newaxis, :], step_length, edge_type)[0]
+    elif method == "cumsum":
+        xcorr = _xcorr_cumsum(data[np.newaxis, :], step_length, edge_type)[0]
+
     edge_position = np.argmax(xcorr).astype(float)
     xcorr_amplitude = np.amax(xcorr)
 
@@ -47,17 +63,212 @@ def find_edge_1d(data, step_length=50, edge_type="falling"):
     return {"edge_pos": edge_position, "xcorr": xcorr, "xcorr_ampl": xcorr_amplitude}
 
 
-def find_edge(data, step_length=50, edge_type="falling", refinement=1):
-    # refine data
-    data_length = data.shape[1]
-    refined_data = np.apply_along_axis(
-        _interpolate_row,
-        axis=1,
-        arr=data,
-        x_known=np.arange(data_length),
-        x_interp=np.arange(0, data_length - 1, refinement),
-    )
+def find_edge(
+    data,
+    step_length=50,
+    edge_type="falling",
+    refinement=1,
+    method="direct",
+    subpixel=None,
+    search_window=None,
+    return_xcorr=True,
+):
+    """Find edges in data waveforms via cross-correlation with a step waveform.
+
+    Args:
+        data: 2D array of waveforms, one per row
+        step_length: length of a step waveform in pix
+        edge_type: {'falling', 'rising'} a type of edge to search for
+        refinement: quantisation size for linear interpolation of data and a step waveform
+        method: {'direct', 'fft', 'cumsum'} cross-correlation method
+            'direct': correlate every waveform separately
+            'fft': correlate all waveforms at once in the frequency domain
+            'cumsum': correlate all waveforms at once via cumulative sums, the cost doesn't
+                depend on step_length (only for refinement == 1)
+        subpixel: {None, 'parabolic', 'gaussian', 'centroid'} estimate edge positions with
+            sub-sample precision by fitting a cross-correlation maximum and its neighbours
+        search_window: if not None, find edges on the unrefined data first, and then refine them
+            only within +/- search_window pix around the coarse positions
+        return_xcorr: return cross-correlation results (in the coarse-to-fine search, values
+            outside of search windows are NaN)
+    Returns:
+        edge position(s) in pix, cross-correlation results and their amplitudes
+    """
+    if method not in xcorr_methods:
+        raise ValueError(f"Unknown cross-correlation method '{method}'")
+
+    if method == "cumsum" and refinement != 1:
+        raise ValueError("Cross-correlation method 'cumsum' requires refinement == 1")
+
+    if subpixel not in subpixel_methods:
+        raise ValueError(f"Unknown sub-pixel method '{subpixel}'")
+
+    if search_window is None:
+        # refine data and find edges
+        refined_data = _refine(data, refinement)
+        xcorr = _xcorr(refined_data, step_length, edge_type, refinement, method)
+        window_start = 0
+
+    else:
+        # find coarse edges, the refined grid with refinement == 1 has no interpolation
+        coarse_xcorr = _xcorr_cumsum(_refine(data, 1), step_length, edge_type, 1)
+        coarse_index = np.argmax(coarse_xcorr, axis=1)
+
+        # refine data only around coarse edges and find edges there
+        refined_length = _refine_plan(data.shape[1], refinement)[0].size
+        kernel_length = _step_waveform(step_length, edge_type, refinement).size
+        xcorr_length = refined_length - kernel_length + 1
+        window_length = min(int(2 * search_window / refinement) + 1, xcorr_length)
+
+        window_start = np.round((coarse_index - search_window) / refinement).astype(int)
+        np.clip(window_start, 0, xcorr_length - window_length, out=window_start)
 
+        refined_index = window_start[:, np.newaxis] + np.arange(window_length + kernel_length - 1)
+        refined_data = _refine(data, refinement, refined_index)
+        xcorr = _xcorr(refined_data, step_length, edge_type, refinement, method)
+
+    edge_index = np.argmax(xcorr, axis=1)
+    edge_position = (edge_index + window_start).astype(float)
+    xcorr_amplitude = np.amax(xcorr, axis=1)
+
+    if subpixel is not None:
+        edge_position += _subpixel_offset(xcorr, edge_index, subpixel)
+
+    edge_position *= refinement
+
+    # correct edge_position for step_length
+    edge_position += np.floor(step_length / 2)
+
+    output = {"edge_pos": edge_position, "xcorr_ampl": xcorr_amplitude}
+
+    if return_xcorr:
+        if search_window is not None:
+            # place windowed results into the full cross-correlation array
+            xcorr_window = xcorr
+            xcorr = np.full((data.shape[0], xcorr_length), np.nan)
+            np.put_along_axis(
+                xcorr, window_start[:, np.newaxis] + np.arange(window_length), xcorr_window, axis=1
+            )
+
+        output["xcorr"] = xcorr
+
+    return output
+
+
+def _xcorr(data, step_length, edge_type, refinement, method):
+    """Cross-correlate every row of 2D data with a step waveform in the 'valid' mode.
+    """
+    if method == "direct":
+        step_waveform = _step_waveform(step_length, edge_type, refinement)
+        if data.shape[0] == 0:
+            # apply_along_axis does not accept empty data
+            xcorr = np.empty((0, data.shape[1] - step_waveform.size + 1))
+        else:
+            xcorr = np.apply_along_axis(np.correlate, 1, data, v=step_waveform, mode="valid")
+    elif method == "fft":
+        xcorr = _xcorr_fft(data, step_length, edge_type, refinement)
+    elif method == "cumsum":
+        xcorr = _xcorr_cumsum(data, step_length, edge_type, refinement)
+
+    return xcorr
+
+
+def _subpixel_offset(xcorr, edge_index, method):
+    """Estimate sub-sample offsets of cross-correlation maxima from 3-point fits.
+
+    Args:
+        xcorr: 2D array of cross-correlation results, one per row
+        edge_index: indices of cross-correlation maxima in every row
+        method: {'parabolic', 'gaussian', 'centroid'} a fit method
+    Returns:
+        offsets in the units of xcorr samples (0 for maxima at the xcorr boundaries)
+    """
+    offset = np.zeros(edge_index.shape)
+    xcorr_length = xcorr.shape[1]
+    if xcorr_length < 3:
+        return offset
+
+    rows = np.arange(xcorr.shape[0])
+    center = np.clip(edge_index, 1, xcorr_length - 2)
+    y_l = xcorr[rows, center - 1]
+    y_c = xcorr[rows, center]
+    y_r = xcorr[rows, center + 1]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if method == "gaussian":
+            # a gaussian is a parabola in the log scale, which requires positive values
+            positive = (y_l > 0) & (y_c > 0) & (y_r > 0)
+            y_l = np.where(positive, np.log(np.abs(y_l)), y_l)
+            y_c = np.where(positive, np.log(np.abs(y_c)), y_c)
+            y_r = np.where(positive, np.log(np.abs(y_r)), y_r)
+
+        if method in ("parabolic", "gaussian"):
+            offset = 0.5 * (y_l - y_r) / (y_l - 2 * y_c + y_r)
+        elif method == "centroid":
+            y_min = np.minimum(y_l, y_r)
+            offset = (y_r - y_l) / (y_l + y_c + y_r - 3 * y_min)
+
+    # flat tops and maxima at the xcorr boundaries can not be fitted
+    offset[~np.isfinite(offset) | (center != edge_index)] = 0
+
+    return offset
+
+
+@lru_cache(maxsize=32)
+def _refine_plan(data_length, refinement):
+    """Plan linear interpolation of waveforms of `data_length` onto a grid with `refinement` step.
+
+    Returns:
+        indices of left neighbours of the refined grid points and their interpolation weights
+    """
+    x_interp = np.arange(0, data_length - 1, refinement)
+    ind = np.minimum(np.floor(x_interp).astype(int), data_length - 2)
+    weights = x_interp - ind
+
+    ind.flags.writeable = False
+    weights.flags.writeable = False
+
+    return ind, weights
+
+
+def _refine(data, refinement, refined_index=None):
+    """Linearly interpolate every row of 2D data onto a grid with `refinement` step.
+
+    Args:
+        data: 2D array of waveforms, one per row
+        refinement: quantisation size for linear interpolation
+        refined_index: (optional) 2D array of refined grid indices to be calculated per row
+    Returns:
+        refined data
+    """
+    ind, weights = _refine_plan(data.shape[1], refinement)
+
+    if refined_index is not None:
+        ind = ind[refined_index]
+        weights = weights[refined_index]
+    else:
+        # the same grid for all rows
+        ind = np.broadcast_to(ind, (data.shape[0], ind.size))
+
+    if not weights.any():
+        # the refined grid coincides with data points
+        return np.take_along_axis(data, ind, axis=1)
+
+    refined_data = np.take_along_axis(data, ind, axis=1)
+    refined_slope = np.take_along_axis(data, ind + 1, axis=1)
+    refined_slope -= refined_data
+    refined_slope *= weights
+    refined_data += refined_slope
+
+    return refined_data
+
+
+@lru_cache(maxsize=32)
+def _step_waveform(step_length, edge_type, refinement=None):
+    """Return a step waveform, that is used as a kernel in `find_edge` and `find_edge_1d`.
+
+    The step waveform is refined only if `refinement` is not None.
+    """
     # prepare a step function and refine it
     step_waveform = np.ones(shape=(step_length,))
     if edge_type == "rising":
@@ -65,99 +276,406 @@ def find_edge(data, step_length=50, edge_type="falling", refinement=1):
     elif edge_type == "falling":
         step_waveform[int(step_length / 2) :] = -1
 
-    step_waveform = np.interp(
-        x=np.arange(0, step_length - 1, refinement), xp=np.arange(step_length), fp=step_waveform
+    if refinement is not None:
+        step_waveform = np.interp(
+            x=np.arange(0, step_length - 1, refinement),
+            xp=np.arange(step_length),
+            fp=step_waveform,
+        )
+
+    # the result is cached, so protect it from modifications
+    step_waveform.flags.writeable = False
+
+    return step_waveform
+
+
+@lru_cache(maxsize=32)
+def _fft_plan(data_length, step_length, edge_type, refinement=None):
+    """Plan cross-correlation of waveforms of `data_length` with a step waveform in the
+    frequency domain.
+
+    Returns:
+        fft length, conjugated spectrum of a step waveform, length of cross-correlation results
+    """
+    step_waveform = _step_waveform(step_length, edge_type, refinement)
+
+    # circular correlation doesn't wrap around within the 'valid' part for fft_length >= data_length
+    fft_length = next_fast_len(data_length, real=True)
+    step_spectrum = np.conj(rfft(step_waveform, fft_length))
+    step_spectrum.flags.writeable = False
+
+    return fft_length, step_spectrum, data_length - step_waveform.size + 1
+
+
+def _xcorr_fft(data, step_length, edge_type, refinement=None):
+    """Cross-correlate every row of 2D data with a step waveform in the 'valid' mode via fft.
+    """
+    fft_length, step_spectrum, xcorr_length = _fft_plan(
+        data.shape[1], step_length, edge_type, refinement
     )
 
-    # find edges
-    xcorr = np.apply_along_axis(np.correlate, 1, refined_data, v=step_waveform, mode="valid")
-    edge_position = np.argmax(xcorr, axis=1).astype(float) * refinement
-    xcorr_amplitude = np.amax(xcorr, axis=1)
+    xcorr = irfft(rfft(data, fft_length, axis=1) * step_spectrum, fft_length, axis=1)
 
-    # correct edge_position for step_length
-    edge_position += np.floor(step_length / 2)
+    return xcorr[:, :xcorr_length]
 
-    return {"edge_pos": edge_position, "xcorr": xcorr, "xcorr_ampl": xcorr_amplitude}
 
+def _xcorr_cumsum(data, step_length, edge_type, refinement=None):
+    """Cross-correlate every row of 2D data with a step waveform in the 'valid' mode via
+    cumulative sums.
 
-def savgol_filter_1d(data, period, window, steps):
-    C = 2.99792458
-    freq = C / np.linspace(*window, steps)
-    freq_interp = np.linspace(C / window[1], C / window[0], steps)
+    A step waveform consists of only +1 and -1 values (unless it is refined), so its
+    cross-correlation with data is a difference of two moving sums.
+    """
+    step_waveform = _step_waveform(step_length, edge_type, refinement)
+    kernel_length = step_waveform.size
+    step_pos = int(step_length / 2)
 
-    tmp = np.interp(freq_interp, freq[::-1], data[::-1])
-    tmp2 = signal.savgol_filter(tmp, period, 1)
-    data_out = np.interp(freq, freq_interp, tmp2)
+    data_length = data.shape[1]
+    data_cumsum = np.zeros((data.shape[0], data_length + 1))
+    np.cumsum(data, axis=1, out=data_cumsum[:, 1:])
+
+    xcorr_length = data_length - kernel_length + 1
+    xcorr = 2 * data_cumsum[:, step_pos : step_pos + xcorr_length]
+    xcorr -= data_cumsum[:, :xcorr_length]
+    xcorr -= data_cumsum[:, kernel_length:]
 
-    return data_out
+    if edge_type == "rising":
+        np.negative(xcorr, out=xcorr)
 
+    return xcorr
 
-def savgol_filter(data, period, window, steps):
-    C = 2.99792458
-    freq = C / np.linspace(*window, steps)
-    freq_interp = np.linspace(C / window[1], C / window[0], steps)
 
-    tmp = np.apply_along_axis(_interpolate_row, 0, data[::-1], freq[::-1], freq_interp)
-    tmp2 = signal.savgol_filter(tmp, period, 1)
-    data_out = np.apply_along_axis(_interpolate_row, 0, tmp2, freq_interp, freq)
+class SavgolFilter:
+    """Savitzky-Golay filter of waveforms, which is applied on a uniform frequency grid.
+
+    Waveforms are sampled uniformly in wavelength, so they are resampled to a uniform frequency
+    grid, filtered and resampled back. All three linear steps are combined into a single banded
+    sparse operator at initialization.
+    """
 
-    return data_out
+    def __init__(self, period, window, steps):
+        """Initialize SavgolFilter object.
 
+        Args:
+            period: length of the filter window in samples
+            window: wavelength range of waveforms
+            steps: number of waveform samples
+        """
+        C = 2.99792458
+        freq = C / np.linspace(*window, steps)
+        freq_interp = np.linspace(C / window[1], C / window[0], steps)
 
-def _interpolate_row(y_known, x_known, x_interp):
-    y_interp = np.interp(x_interp, x_known, y_known)
-    return y_interp
+        # waveforms are reversed to get increasing frequencies
+        to_freq_interp = interp_operator(freq_interp, freq[::-1])[:, ::-1]
+        from_freq_interp = interp_operator(freq, freq_interp)
+        savgol = _savgol_operator(steps, period, 1)
 
+        self.period = period
+        self.window = window
+        self.steps = steps
+        self._operator = (from_freq_interp @ savgol @ to_freq_interp).tocsr()
 
-def read_bsread_file(filepath, signal_channel, events_channel, dark_shot_event, dark_shot_filter):
+    def __call__(self, data, axis=-1):
+        """Apply filter to waveforms along an axis of data.
+
+        Args:
+            data: single waveform or an array of waveforms, e.g. (n_shots, n_pixels)
+            axis: axis of data along which waveforms are sampled
+        Returns:
+            filtered data
+        """
+        data = np.moveaxis(data, axis, -1)
+        data_out = (self._operator @ data.reshape(-1, self.steps).T).T
+
+        return np.moveaxis(data_out.reshape(data.shape), -1, axis)
+
+
+def interp_operator(x, xp):
+    """Return a sparse linear interpolation operator.
+
+    The operator can be applied to many waveforms sampled at the same points at once, e.g.
+    `data @ A.T` for 2D data with one waveform per row.
+
+    Args:
+        x: x-coordinates at which to evaluate the interpolated values
+        xp: increasing x-coordinates of the data points
+    Returns:
+        sparse csr matrix `A` of shape (x.size, xp.size), such that `A @ fp` is equal to
+        `np.interp(x, xp, fp)`
+    """
+    ind = np.searchsorted(xp, x, side="right") - 1
+    np.clip(ind, 0, xp.size - 2, out=ind)
+
+    weights = (x - xp[ind]) / (xp[ind + 1] - xp[ind])
+    np.clip(weights, 0, 1, out=weights)
+
+    rows = np.arange(x.size)
+    operator = sparse.csr_matrix(
+        (
+            np.concatenate((1 - weights, weights)),
+            (np.tile(rows, 2), np.concatenate((ind, ind + 1))),
+        ),
+        shape=(x.size, xp.size),
+    )
+
+    return operator
+
+
+def _savgol_operator(length, period, polyorder):
+    """Return a sparse matrix `S`, such that `S @ x` is equal to
+    `signal.savgol_filter(x, period, polyorder)` for vectors `x` of `length`.
+    """
+    half_period = period // 2
+
+    # polynomial fits at edges ('interp' mode), rows of the operator for a single window
+    edges = signal.savgol_filter(np.eye(period), period, polyorder, axis=0)
+    coeffs = signal.savgol_coeffs(period, polyorder, use="dot")
+
+    rows_left = np.repeat(np.arange(half_period), period)
+    cols_left = np.tile(np.arange(period), half_period)
+    vals_left = edges[:half_period].ravel()
+
+    rows_right = np.repeat(np.arange(length - half_period, length), period)
+    cols_right = np.tile(np.arange(length - period, length), half_period)
+    vals_right = edges[half_period + 1 :].ravel()
+
+    rows_center = np.repeat(np.arange(half_period, length - half_period), period)
+    cols_center = np.tile(np.arange(-half_period, half_period + 1), length - period + 1)
+    cols_center += rows_center
+    vals_center = np.tile(coeffs, length - period + 1)
+
+    operator = sparse.csr_matrix(
+        (
+            np.concatenate((vals_left, vals_center, vals_right)),
+            (
+                np.concatenate((rows_left, rows_center, rows_right)),
+                np.concatenate((cols_left, cols_center, cols_right)),
+            ),
+        ),
+        shape=(length, length),
+    )
+
+    return operator
+
+
+@lru_cache(maxsize=8)
+def _get_savgol_filter(period, window, steps):
+    return SavgolFilter(period, window, steps)
+
+
+def savgol_filter_1d(data, period, window, steps):
+    return _get_savgol_filter(period, tuple(window), steps)(data)
+
+
+def savgol_filter(data, period, window, steps, axis=0):
+    """Filter all waveforms of 2D data at once, e.g. axis=1 for (n_shots, n_pixels) arrays.
+    """
+    return _get_savgol_filter(period, tuple(window), steps)(data, axis=axis)
+
+
+def read_bsread_file(
+    filepath,
+    signal_channel,
+    events_channel,
+    dark_shot_event,
+    dark_shot_filter,
+    roi=(None, None),
+    roi_x=(None, None),
+    memmap=False,
+    rdcc_nbytes=RDCC_NBYTES,
+):
     """Read encoder data from bsread hdf5 file.
+
+    Only the region of interest of camera images (`roi` along y-axis and `roi_x` along x-axis) is
+    read from the file. Contiguous uncompressed datasets are memory-mapped if `memmap` is True.
     """
-    with h5py.File(filepath, "r") as h5f:
-        if "/data" in h5f:
-            # sf_databuffer_writer format
-            path_prefix = "/data/{}"
-        else:
-            # bsread format
-            path_prefix = "/{}"
+    with BsreadReader(filepath, memmap=memmap, rdcc_nbytes=rdcc_nbytes) as reader:
+        return reader.read(
+            signal_channel, events_channel, dark_shot_event, dark_shot_filter, roi, roi_x
+        )
+
+
+def iter_bsread_file(
+    filepath,
+    signal_channel,
+    events_channel=None,
+    dark_shot_event=21,
+    dark_shot_filter=None,
+    roi=(None, None),
+    chunk_size=1000,
+    dtype=float,
+    *,
+    roi_x=(None, None),
+    memmap=False,
+    rdcc_nbytes=RDCC_NBYTES,
+):
+    """Read encoder data from bsread hdf5 file in chunks of shots with bounded memory.
+
+    Args:
+        filepath: path to a bsread hdf5 file to read data from
+        signal_channel: data channel of encoder
+        events_channel: data channel of events
+        dark_shot_event: event number for dark shots if events_channel is present
+        dark_shot_filter: a function to return True for dark shots based on pulse_id argument
+        roi: region of interest for image projection along y-axis
+        chunk_size: number of shots per chunk
+        dtype: data type of projected waveforms (and of the projection accumulator)
+        roi_x: (keyword-only) region of interest along x-axis
+        memmap: memory-map contiguous uncompressed datasets instead of reading them
+        rdcc_nbytes: size of the hdf5 raw data chunk cache per dataset in bytes
+    Yields:
+        pulse_id, is_dark, data of every chunk
+    """
+    with BsreadReader(filepath, memmap=memmap, rdcc_nbytes=rdcc_nbytes) as reader:
+        yield from reader.iter_chunks(
+            signal_channel,
+            events_channel,
+            dark_shot_event,
+            dark_shot_filter,
+            roi,
+            roi_x,
+            chunk_size,
+            dtype,
+        )
+
+
+def process_chunks(process, chunks, debug=False):
+    """Process chunks of encoder data and concatenate per-shot results.
+
+    Args:
+        process: processing function, e.g. `process` method of an encoder
+        chunks: iterable over (pulse_id, is_dark, data) chunks, e.g. from `iter_bsread_file`
+        debug: return debug data
+    Returns:
+        results of processing, pulse_id, is_dark
+    """
+    outputs = []
+    pulse_ids = []
+    is_darks = []
+    for pulse_id, is_dark, data in chunks:
+        outputs.append(process(data, debug=debug))
+        pulse_ids.append(pulse_id)
+        is_darks.append(is_dark)
 
-        signal_channel_group = h5f[path_prefix.format(signal_channel)]
-        signal_pulse_id = signal_channel_group["pulse_id"][:]
+    if not outputs:
+        # no shots are left after pulse id alignment or filtering
+        return {"edge_pos": np.empty(0)}, np.empty(0, dtype=np.int64), None
 
-        if events_channel:
-            events_channel_group = h5f[path_prefix.format(events_channel)]
-            events_pulse_id = events_channel_group["pulse_id"][:]
+    output = concatenate_results(outputs)
+    pulse_id = np.concatenate(pulse_ids)
 
-            pid, index, event_index = np.intersect1d(
-                signal_pulse_id, events_pulse_id, return_indices=True
-            )
+    if is_darks[0] is None:
+        is_dark = None
+    else:
+        is_dark = np.concatenate(is_darks)
 
-            # if both groups have 0 in their pulse_id
-            pid_zero_ind = pid == 0
-            if any(pid_zero_ind):
-                warnings.warn(
-                    f"\n \
-                File: {filepath}\n \
-                Both '{signal_channel}' and '{events_channel}' have zeroed pulse_id(s).\n"
-                )
-                index = index[~pid_zero_ind]
-                event_index = event_index[~pid_zero_ind]
+    return output, pulse_id, is_dark
 
-            is_dark = events_channel_group["data"][event_index, dark_shot_event].astype(bool)
 
-        elif dark_shot_filter:
-            index = signal_pulse_id != 0
-            is_dark = dark_shot_filter(signal_pulse_id)[index]
+def concatenate_results(outputs):
+    """Concatenate per-shot results of consecutive parts of data.
+
+    Args:
+        outputs: list of dictionaries with results of every part
+    Returns:
+        dictionary with concatenated results (empty if there are no parts)
+    """
+    if not outputs:
+        return {}
+
+    return {key: np.concatenate([output[key] for output in outputs]) for key in outputs[0]}
+
+
+class ScratchArray:
+    """Descriptor of an array that is passed between processes via a scratch file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+
+def map_via_scratch(pool, func, iterable):
+    """Map a function that returns dictionaries with results over an iterable in a process pool.
+
+    Instead of pickling large result arrays and sending them through pipes, worker processes save
+    them to scratch files and return only their descriptors, then the arrays are loaded back in
+    the calling process and the files are removed.
+
+    Args:
+        pool: process pool, e.g. multiprocessing.Pool
+        func: function to be applied to every item of iterable, returning a dictionary
+        iterable: items to be processed
+    Returns:
+        list of results
+    """
+    with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as scratch_dir:
+        output = pool.map(partial(_call_via_scratch, func, scratch_dir), iterable)
+        return [load_arrays(result) for result in output]
+
+
+def imap_via_scratch(pool, func, iterable):
+    """Map a function that returns dictionaries with results over an iterable in a process pool,
+    yielding results in order of completion.
+
+    Large result arrays are passed via scratch files as in `map_via_scratch`.
+
+    Args:
+        pool: process pool, e.g. multiprocessing.Pool
+        func: function to be applied to every item of iterable, returning a dictionary
+        iterable: items to be processed
+    Yields:
+        index of an item in iterable, its result, processing time of the item in s
+    """
+    with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as scratch_dir:
+        results = pool.imap_unordered(
+            partial(_call_indexed_via_scratch, func, scratch_dir), enumerate(iterable)
+        )
+        for i, result, process_time in results:
+            yield i, load_arrays(result), process_time
+
+
+def dump_arrays(result, scratch_dir):
+    """Replace large arrays of a result by descriptors of scratch files with their data.
+
+    Args:
+        result: dictionary with results
+        scratch_dir: directory for scratch files
+    Returns:
+        result with ScratchArray descriptors
+    """
+    for key, value in result.items():
+        if isinstance(value, np.ndarray) and value.nbytes >= SCRATCH_MIN_NBYTES:
+            fd, path = tempfile.mkstemp(suffix=".npy", dir=scratch_dir)
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, value, allow_pickle=False)
+            result[key] = ScratchArray(path)
+
+    return result
+
+
+def load_arrays(result):
+    """Load arrays of a result from scratch files and remove the files.
+
+    Args:
+        result: dictionary with results and ScratchArray descriptors
+    Returns:
+        result with arrays
+    """
+    for key, value in result.items():
+        if isinstance(value, ScratchArray):
+            result[key] = np.load(value.path)
+            os.remove(value.path)
+
+    return result
 
-        else:
-            index = signal_pulse_id != 0
-            is_dark = None
 
-        signal_pulse_id = signal_pulse_id[index]
+def _call_via_scratch(func, scratch_dir, *args):
+    return dump_arrays(func(*args), scratch_dir)
 
-        # data is stored as uint16 in hdf5, so has to be casted to float for further analysis,
-        images = signal_channel_group["data"][index].astype(float)
 
-        # averaging every image over y-axis gives the final raw waveforms
-        data = images.mean(axis=1)
+def _call_indexed_via_scratch(func, scratch_dir, item):
+    i, arg = item
+    start_time = time.perf_counter()
+    result = dump_arrays(func(arg), scratch_dir)
 
-    return data, signal_pulse_id, is_dark
+    return i, result, time.perf_counter() - start_time
@@ -0,0 +1,36 @@
+import h5py
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def make_bsread_file(tmp_path):
+    """Return a function that writes a bsread file with spatial encoder images and events.
+
+    Every 10th pulse is a dark shot (with event 21).
+    """
+
+    def make(name="data.h5", n=50, ny=10, nx=300, seed=0):
+        rng = np.random.default_rng(seed)
+        pulse_id = np.arange(1000, 1000 + 2 * n, 2, dtype=np.int64)
+        dark = (pulse_id // 2) % 10 == 0
+
+        x = np.arange(nx)
+        edge = rng.uniform(100, 200, n)
+        waveforms = 1000 + 1000 / (1 + np.exp((x[None, :] - edge[:, None]) / 3))
+        waveforms[dark] = 2000
+        images = waveforms[:, None, :] + rng.normal(0, 30, (n, ny, nx))
+
+        events = np.zeros((n, 256), dtype=np.int32)
+        events[dark, 21] = 1
+
+        filepath = tmp_path / name
+        with h5py.File(filepath, "w") as h5f:
+            h5f["data/CAM/pulse_id"] = pulse_id
+            h5f["data/CAM/data"] = images.astype(np.uint16)
+            h5f["data/EVT/pulse_id"] = pulse_id
+            h5f["data/EVT/data"] = events
+
+        return str(filepath)
+
+    return make
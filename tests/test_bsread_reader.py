@@ -0,0 +1,95 @@
+import logging
+
+import h5py
+import numpy as np
+import pytest
+
+from photodiag import bsread_reader
+from photodiag.bsread_reader import align_pulse_ids, read_rows, report_alignment
+
+
+def reference_alignment(pulse_ids):
+    """Align pulse ids via sorting, first occurrences of duplicated pulse ids are kept.
+    """
+    common_ids = np.unique(pulse_ids[0][pulse_ids[0] != 0])
+    for pid in pulse_ids[1:]:
+        common_ids = np.intersect1d(common_ids, pid[pid != 0])
+
+    indices = []
+    for pid in pulse_ids:
+        valid_index = np.flatnonzero(pid)
+        order = np.argsort(pid[valid_index], kind="stable")
+        first = np.searchsorted(pid[valid_index][order], common_ids)
+        indices.append(valid_index[order][first])
+
+    return common_ids, indices
+
+
+# pulse id steps of dense (merged via a lookup table) and sparse (merged via binary searches) data
+@pytest.mark.parametrize("step", [2, 1000])
+@pytest.mark.parametrize("seed", range(5))
+def test_align_pulse_ids(seed, step):
+    rng = np.random.default_rng(seed)
+
+    pulse_ids = []
+    for _ in range(3):
+        pid = np.arange(1000, 1000 + 1000 * step, step)
+        pid = pid[rng.random(pid.size) > 0.05]
+        pid = np.sort(np.concatenate((pid, rng.choice(pid, 10))))
+        pid[rng.random(pid.size) < 0.03] = 0
+        pulse_ids.append(pid)
+
+    # a channel with pulse ids stored out of order
+    pulse_ids[2] = pulse_ids[2][rng.permutation(pulse_ids[2].size)]
+
+    common_ids, indices, stats = align_pulse_ids(pulse_ids)
+    ref_common_ids, ref_indices = reference_alignment(pulse_ids)
+
+    np.testing.assert_array_equal(common_ids, ref_common_ids)
+    for pid, index, ref_index, channel_stats in zip(pulse_ids, indices, ref_indices, stats):
+        np.testing.assert_array_equal(index, ref_index)
+        np.testing.assert_array_equal(pid[index], common_ids)
+
+        n_unique = np.unique(pid[pid != 0]).size
+        assert channel_stats["zeroed"] == np.count_nonzero(pid == 0)
+        assert channel_stats["duplicated"] == pid.size - channel_stats["zeroed"] - n_unique
+        assert channel_stats["dropped"] == n_unique - common_ids.size
+
+
+def test_align_pulse_ids_disjoint():
+    common_ids, indices, stats = align_pulse_ids([np.array([2, 4, 6]), np.array([0, 8, 10])])
+
+    assert common_ids.size == 0
+    assert all(index.size == 0 for index in indices)
+    assert [channel_stats["dropped"] for channel_stats in stats] == [3, 2]
+
+
+def test_report_alignment(caplog):
+    _, _, stats = align_pulse_ids([np.array([2, 4, 4, 6]), np.array([0, 4, 6, 8])])
+
+    with caplog.at_level(logging.INFO, logger="photodiag.bsread_reader"):
+        report_alignment("file.h5", {"signal": stats[0], "events": stats[1]})
+
+    warnings = [r.message for r in caplog.records if r.levelno == logging.WARNING]
+    assert len(warnings) == 1 and "'signal'" in warnings[0]
+
+    infos = [r.message for r in caplog.records if r.levelno == logging.INFO]
+    assert len(infos) == 2
+
+
+@pytest.mark.parametrize("chunks", [None, (4, 3, 8)])
+@pytest.mark.parametrize("zeroed", [0, 0.03, 0.3, 0.95])
+@pytest.mark.parametrize("selection", [(), (slice(1, 3), slice(None, 5)), (2,)])
+def test_read_rows(tmp_path, monkeypatch, chunks, zeroed, selection):
+    # small blocks, so that every read spans several blocks
+    monkeypatch.setattr(bsread_reader, "MAX_BLOCK_NBYTES", 20 * 3 * 8 * 2)
+
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 1000, (200, 3, 8), dtype=np.uint16)
+    with h5py.File(tmp_path / "data.h5", "w") as h5f:
+        dataset = h5f.create_dataset("data", data=data, chunks=chunks)
+
+        mask = rng.random(data.shape[0]) >= zeroed
+        for index in (mask, np.flatnonzero(mask)):
+            output = read_rows(dataset, index, selection)
+            np.testing.assert_array_equal(output, data[(np.flatnonzero(mask), *selection)])
@@ -0,0 +1,76 @@
+import functools
+
+import numpy as np
+import pytest
+
+from photodiag import ResultCache, SpatialEncoder
+
+
+def make_filter(period):
+    def dark_shot_filter(pulse_id):
+        return pulse_id % period == 0
+
+    return dark_shot_filter
+
+
+def scale(x, factor=1):
+    return x * factor
+
+
+class Opaque:
+    pass
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(tmp_path / "cache")
+
+
+def test_key_closures(cache, make_bsread_file):
+    filepath = make_bsread_file()
+
+    key_3 = cache.key(filepath, {"dark_shot_filter": make_filter(3)})
+    key_4 = cache.key(filepath, {"dark_shot_filter": make_filter(4)})
+
+    assert key_3 != key_4
+    assert key_3 == cache.key(filepath, {"dark_shot_filter": make_filter(3)})
+
+
+def test_key_defaults_and_partials(cache, make_bsread_file):
+    filepath = make_bsread_file()
+
+    def with_default(x, factor=2):
+        return x * factor
+
+    key_default = cache.key(filepath, {"func": with_default})
+    with_default.__defaults__ = (3,)
+    assert key_default != cache.key(filepath, {"func": with_default})
+
+    key_partial = cache.key(filepath, {"func": functools.partial(scale, factor=2)})
+    assert key_partial is not None
+    assert key_partial == cache.key(filepath, {"func": functools.partial(scale, factor=2)})
+    assert key_partial != cache.key(filepath, {"func": functools.partial(scale, factor=3)})
+
+
+def test_key_unstable(cache, make_bsread_file):
+    filepath = make_bsread_file()
+
+    with pytest.warns(UserWarning):
+        key = cache.key(filepath, {"param": Opaque()})
+
+    assert key is None
+    assert cache.get(key) is None
+
+
+def test_process_hdf5_closures(cache, make_bsread_file):
+    filepath = make_bsread_file()
+
+    for period in (20, 40):
+        encoder = SpatialEncoder("CAM", dark_shot_filter=make_filter(period), cache=cache)
+        cached = encoder.process_hdf5(filepath)
+
+        encoder = SpatialEncoder("CAM", dark_shot_filter=make_filter(period))
+        expected = encoder.process_hdf5(filepath)
+
+        np.testing.assert_array_equal(cached["pulse_id"], expected["pulse_id"])
+        np.testing.assert_array_equal(cached["edge_pos"], expected["edge_pos"])
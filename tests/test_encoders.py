@@ -0,0 +1,31 @@
+import h5py
+import numpy as np
+import pytest
+
+from photodiag import FileAdapter, SpatialEncoder, SpectralEncoder
+
+
+def make_encoders():
+    encoders = [
+        SpatialEncoder("CAM"),
+        SpectralEncoder("CAM", "CAM", events_channel="EVT"),
+        FileAdapter("CAM", "CAM"),
+    ]
+    for encoder in encoders:
+        encoder._background = np.full(300, 2000.0)
+
+    return encoders
+
+
+@pytest.mark.parametrize("nproc", [1, 2])
+@pytest.mark.parametrize("chunk_size", [None, 16])
+def test_process_hdf5_zero_shots(make_bsread_file, nproc, chunk_size):
+    filepath = make_bsread_file()
+    with h5py.File(filepath, "a") as h5f:
+        h5f["data/CAM/pulse_id"][:] = 0
+
+    for encoder in make_encoders():
+        output = encoder.process_hdf5(filepath, chunk_size=chunk_size, nproc=nproc)
+
+        assert output["pulse_id"].size == 0
+        assert output["edge_pos"].size == 0
@@ -0,0 +1,88 @@
+import h5py
+import numpy as np
+import pytest
+
+from photodiag import PalmSetup
+from photodiag.palm_code import load_palm_file, palm_file_shots
+
+N_BINS = 500
+
+
+def make_palm_setup():
+    palm = PalmSetup(
+        {"0": "ETOF0", "1": "ETOF1"},
+        noise_range=(0, 50),
+        energy_range=np.linspace(4850, 5150, 101),
+    )
+    for etof in palm.etofs.values():
+        etof.calib_a, etof.calib_b, etof.calib_t0 = 7071.0, 4800.0, 100
+        etof.internal_time_bins = N_BINS
+        etof.calib_data.loc[0] = {
+            "waveform": 0,
+            "calib_t0": 100,
+            "calib_tpeak": 300,
+            "noise_mean": 0,
+            "noise_std": 0.01,
+            "use_in_fit": True,
+        }
+
+    return palm
+
+
+def make_palm_file(filepath, orders, n=40, seed=0):
+    """Write a bsread PALM file, where rows of every eTOF channel are stored in a given order.
+    """
+    rng = np.random.default_rng(seed)
+    pulse_id = np.arange(1000, 1000 + 2 * n, 2)
+    t = np.arange(N_BINS)
+
+    with h5py.File(filepath, "w") as h5f:
+        for (channel, center), order in zip((("ETOF0", 250.0), ("ETOF1", 260.0)), orders):
+            centers = center + rng.normal(0, 5, (n, 1))
+            data = -np.exp(-(((t - centers) / 10) ** 2)) - rng.normal(0, 0.01, (n, N_BINS))
+            h5f[f"data/{channel}/pulse_id"] = pulse_id[order]
+            h5f[f"data/{channel}/data"] = data[order]
+
+    return str(filepath)
+
+
+@pytest.fixture
+def palm_files(tmp_path):
+    n = 40
+    swapped = np.arange(n)
+    swapped[[5, 6]] = swapped[[6, 5]]
+    # files in separate folders, as the layout of files is remembered per folder
+    (tmp_path / "ordered").mkdir()
+    (tmp_path / "unordered").mkdir()
+    ordered = make_palm_file(tmp_path / "ordered" / "run.h5", [np.arange(n)] * 2, n)
+    unordered = make_palm_file(tmp_path / "unordered" / "run.h5", [swapped, np.arange(n)[::-1]], n)
+
+    return ordered, unordered
+
+
+def test_load_palm_file_unordered(palm_files):
+    ordered, unordered = palm_files
+    etof_paths = {"0": "ETOF0", "1": "ETOF1"}
+
+    assert palm_file_shots(unordered, etof_paths) == palm_file_shots(ordered, etof_paths)
+
+    for rows in (slice(None), slice(3, 17)):
+        ref_tags, ref_data = load_palm_file(ordered, etof_paths, rows=rows)
+        tags, data = load_palm_file(unordered, etof_paths, rows=rows)
+
+        np.testing.assert_array_equal(tags, ref_tags)
+        for etof_key in etof_paths:
+            np.testing.assert_array_equal(data[etof_key], ref_data[etof_key])
+
+
+@pytest.mark.parametrize("nproc", [1, 2])
+def test_process_hdf5_file_unordered(palm_files, nproc):
+    ordered, unordered = palm_files
+    palm = make_palm_setup()
+
+    ref_tags, ref_delays, ref_lengths = palm.process_hdf5_file(ordered)
+    tags, delays, lengths = palm.process_hdf5_file(unordered, nproc=nproc, backend="thread")
+
+    np.testing.assert_array_equal(tags, ref_tags)
+    np.testing.assert_array_equal(delays, ref_delays)
+    np.testing.assert_allclose(lengths, ref_lengths)
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from photodiag import spectrometer
+from photodiag.spectrometer import Spectrometer
+
+N_BINS = 500
+
+
+def make_spectrometer():
+    etof = Spectrometer(noise_range=(0, 50))
+    etof.calib_a, etof.calib_b, etof.calib_t0 = 7071.0, 4800.0, 100
+    etof.internal_time_bins = N_BINS
+    etof.calib_data.loc[0] = {
+        "waveform": 0,
+        "calib_t0": 100,
+        "calib_tpeak": 300,
+        "noise_mean": 0,
+        "noise_std": 0.01,
+        "use_in_fit": True,
+    }
+
+    return etof
+
+
+def baseline_convert(etof, input_data, interp_energy, jacobian, noise_thr):
+    """Reference: per-waveform interpolation of the original implementation."""
+    flight_time = np.arange(1, etof.internal_time_bins - etof.calib_t0)
+    pulse_energy = (etof.calib_a / flight_time) ** 2 + etof.calib_b
+
+    output_data = input_data[:, etof.calib_t0 + 1 :].copy()
+    if jacobian:
+        output_data /= -(pulse_energy ** (3 / 2))
+
+    output_data = np.array(
+        [np.interp(interp_energy, pulse_energy[::-1], row[::-1]) for row in output_data]
+    )
+    output_data -= noise_thr * etof.calib_data["noise_std"].mean()
+
+    return output_data
+
+
+@pytest.mark.parametrize("jacobian", [False, True])
+@pytest.mark.parametrize("block_rows", [4, 1000])
+def test_convert(monkeypatch, jacobian, block_rows):
+    # multiple blocks are processed with a small block size
+    monkeypatch.setattr(spectrometer, "CONVERT_BLOCK_ROWS", block_rows)
+
+    etof = make_spectrometer()
+    rng = np.random.default_rng(0)
+    input_data = rng.normal(size=(10, N_BINS))
+    input_copy = input_data.copy()
+
+    # energies partly outside of the calibrated range are clamped as in np.interp
+    interp_energy = np.linspace(4850, 5150, 101)
+
+    output = etof.convert(input_data, interp_energy, jacobian=jacobian, noise_thr=3)
+    reference = baseline_convert(etof, input_data, interp_energy, jacobian, noise_thr=3)
+
+    np.testing.assert_allclose(output, reference, rtol=1e-10, atol=1e-15)
+    np.testing.assert_array_equal(input_data, input_copy)
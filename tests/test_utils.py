@@ -0,0 +1,171 @@
+import numpy as np
+import pytest
+from scipy import signal
+
+from photodiag.utils import (
+    SavgolFilter,
+    find_edge,
+    find_edge_1d,
+    interp_operator,
+    savgol_filter,
+    savgol_filter_1d,
+    subpixel_methods,
+)
+
+
+def baseline_step_waveform(step_length, edge_type):
+    step_waveform = np.ones(shape=(step_length,))
+    if edge_type == "rising":
+        step_waveform[: int(step_length / 2)] = -1
+    elif edge_type == "falling":
+        step_waveform[int(step_length / 2) :] = -1
+
+    return step_waveform
+
+
+def baseline_find_edge(data, step_length, edge_type, refinement):
+    """Reference: per-row interpolation and correlation of the original implementation."""
+    data_length = data.shape[1]
+    x_interp = np.arange(0, data_length - 1, refinement)
+    refined_data = np.array([np.interp(x_interp, np.arange(data_length), row) for row in data])
+
+    step_waveform = np.interp(
+        x=np.arange(0, step_length - 1, refinement),
+        xp=np.arange(step_length),
+        fp=baseline_step_waveform(step_length, edge_type),
+    )
+
+    xcorr = np.array([np.correlate(row, step_waveform, mode="valid") for row in refined_data])
+    edge_position = np.argmax(xcorr, axis=1).astype(float) * refinement
+    edge_position += np.floor(step_length / 2)
+
+    return {"edge_pos": edge_position, "xcorr": xcorr, "xcorr_ampl": np.amax(xcorr, axis=1)}
+
+
+def baseline_savgol_filter_1d(data, period, window, steps):
+    C = 2.99792458
+    freq = C / np.linspace(*window, steps)
+    freq_interp = np.linspace(C / window[1], C / window[0], steps)
+
+    tmp = np.interp(freq_interp, freq[::-1], data[::-1])
+    tmp2 = signal.savgol_filter(tmp, period, 1)
+
+    return np.interp(freq, freq_interp, tmp2)
+
+
+def make_waveforms(edge_type, n=20, length=300, seed=0):
+    rng = np.random.default_rng(seed)
+    edges = rng.uniform(60, 240, n)
+    x = np.arange(length)
+    waveforms = 1 / (1 + np.exp((x - edges[:, np.newaxis]) / 4)) + rng.normal(0, 0.05, (n, length))
+    if edge_type == "rising":
+        waveforms = 1 - waveforms
+
+    return waveforms, edges
+
+
+def assert_same_edges(output, reference):
+    np.testing.assert_array_equal(output["edge_pos"], reference["edge_pos"])
+    np.testing.assert_allclose(output["xcorr_ampl"], reference["xcorr_ampl"], rtol=1e-10)
+    np.testing.assert_allclose(output["xcorr"], reference["xcorr"], rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize("method", ["direct", "fft", "cumsum"])
+@pytest.mark.parametrize("edge_type", ["falling", "rising"])
+@pytest.mark.parametrize("step_length", [20, 51])
+@pytest.mark.parametrize("refinement", [1, 0.5, 0.25])
+def test_find_edge(method, edge_type, step_length, refinement):
+    if method == "cumsum" and refinement != 1:
+        pytest.skip("'cumsum' requires refinement == 1")
+
+    data, _ = make_waveforms(edge_type)
+
+    output = find_edge(data, step_length, edge_type, refinement, method=method)
+    reference = baseline_find_edge(data, step_length, edge_type, refinement)
+
+    assert_same_edges(output, reference)
+
+
+@pytest.mark.parametrize("method", ["direct", "fft", "cumsum"])
+@pytest.mark.parametrize("edge_type", ["falling", "rising"])
+def test_find_edge_1d(method, edge_type):
+    data = make_waveforms(edge_type, n=1)[0][0]
+
+    output = find_edge_1d(data, 30, edge_type, method=method)
+    xcorr = np.correlate(data, baseline_step_waveform(30, edge_type), mode="valid")
+
+    assert output["edge_pos"] == np.argmax(xcorr) + 15
+    np.testing.assert_allclose(output["xcorr_ampl"], np.amax(xcorr), rtol=1e-10)
+    np.testing.assert_allclose(output["xcorr"], xcorr, rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize("method", ["direct", "fft"])
+@pytest.mark.parametrize("edge_type", ["falling", "rising"])
+@pytest.mark.parametrize("refinement", [1, 0.5, 0.25])
+@pytest.mark.parametrize("search_window", [3, 10])
+def test_find_edge_search_window(method, edge_type, refinement, search_window):
+    data, _ = make_waveforms(edge_type)
+
+    output = find_edge(data, 30, edge_type, refinement, method=method, search_window=search_window)
+    reference = find_edge(data, 30, edge_type, refinement, method="direct")
+
+    np.testing.assert_array_equal(output["edge_pos"], reference["edge_pos"])
+    np.testing.assert_allclose(output["xcorr_ampl"], reference["xcorr_ampl"], rtol=1e-10)
+
+    # cross-correlation results are present only within search windows
+    in_window = ~np.isnan(output["xcorr"])
+    assert np.all(np.count_nonzero(in_window, axis=1) == int(2 * search_window / refinement) + 1)
+    np.testing.assert_allclose(
+        output["xcorr"][in_window], reference["xcorr"][in_window], rtol=1e-10, atol=1e-10
+    )
+
+
+@pytest.mark.parametrize("subpixel", subpixel_methods[1:])
+@pytest.mark.parametrize("method", ["direct", "fft", "cumsum"])
+def test_find_edge_subpixel(subpixel, method):
+    data, edges = make_waveforms("falling", n=200)
+
+    output = find_edge(data, 30, "falling", method=method, subpixel=subpixel)
+    reference = find_edge(data, 30, "falling", method="direct")
+
+    # sub-pixel offsets stay within a pixel of the cross-correlation maximum
+    assert np.all(np.abs(output["edge_pos"] - reference["edge_pos"]) <= 1)
+
+    # and they are closer to true edge positions than whole pixel positions
+    error = np.abs(output["edge_pos"] - edges).mean()
+    assert error < np.abs(reference["edge_pos"] - edges).mean()
+
+    direct = find_edge(data, 30, "falling", method="direct", subpixel=subpixel)
+    np.testing.assert_allclose(output["edge_pos"], direct["edge_pos"], rtol=1e-10)
+
+
+@pytest.mark.parametrize("x", [np.linspace(-1, 11, 50), np.array([0.0, 10.0]), np.arange(11.0)])
+def test_interp_operator(x):
+    rng = np.random.default_rng(0)
+    xp = np.sort(rng.uniform(0, 10, 11))
+    fp = rng.normal(size=(3, xp.size))
+
+    operator = interp_operator(x, xp)
+
+    for row in fp:
+        np.testing.assert_allclose(operator @ row, np.interp(x, xp, row), rtol=1e-12)
+
+
+@pytest.mark.parametrize("period", [5, 11])
+def test_savgol_filter(period):
+    window, steps = (500, 600), 200
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(4, steps)) + np.linspace(0, 1, steps)
+
+    reference = np.array([baseline_savgol_filter_1d(row, period, window, steps) for row in data])
+
+    np.testing.assert_allclose(SavgolFilter(period, window, steps)(data), reference, atol=1e-12)
+    np.testing.assert_allclose(
+        savgol_filter(data, period, window, steps, axis=1), reference, atol=1e-12
+    )
+    np.testing.assert_allclose(
+        savgol_filter(data.T, period, window, steps).T, reference, atol=1e-12
+    )
+    np.testing.assert_allclose(
+        savgol_filter_1d(data[0], period, window, steps), reference[0], atol=1e-12
+    )